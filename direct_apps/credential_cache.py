@@ -0,0 +1,58 @@
+'''SMART Direct Apps cache of the verified OAuth credentials'''
+# The REST handlers check the SMART OAuth credentials of every request
+# before answering it. The pages of an app session send the same OAuth
+# header with each of their requests, so a header that was verified is
+# remembered for a short time (ttl seconds) with its parsed parameters:
+# the later requests of the session skip parsing it and setting up a
+# SMART client. Only the SHA-1 of the header is used as key.
+#
+#     credentials = CredentialCache(ttl=300)
+#     oa_params = credentials.get(header)
+#     if oa_params is None:
+#         oa_params = oauth.parse_header(header)
+#         ... verify ...
+#         credentials.add(header, oa_params)
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+class CredentialCache(object):
+
+    def __init__(self, ttl=300, max_entries=1024):
+        '''ttl is the number of seconds a header stays verified and
+        max_entries bounds the number of headers remembered'''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # header hash -> (expires, oa_params), oldest first
+        self.lock = threading.Lock()
+
+    def key(self, header):
+        return hashlib.sha1(header).hexdigest()
+
+    def get(self, header):
+        '''Returns the parsed parameters of a verified header, or None if the
+        header was not verified in the last ttl seconds'''
+        key = self.key(header)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def add(self, header, oa_params):
+        '''Remembers a verified header with its parsed parameters'''
+        key = self.key(header)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, oa_params)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,103 @@
+'''SMART Direct Apps cache of the data files and templates'''
+# The pages, the app manifests (data/apps.json) and the recipients
+# (data/addresses.json) are read from disk once and kept in memory, with
+# what has been parsed from them (the JSON data, the compiled templates).
+# A file is read again when its modification time or size changes, so the
+# files can still be edited while the server is running.
+#
+# The raw bytes are served as they are, with an ETag (SHA-1 of the bytes)
+# and a Last-Modified header, so that the browsers can revalidate their
+# copy and get a 304 Not Modified response.
+#
+#     files = FileCache()
+#     apps = files.json(APP_PATH + '/data/apps.json')
+#     return files.serve(APP_PATH + '/data/apps.json', 'application/json')
+#
+# The parsed values are shared by all the requests: they must not be
+# modified by the callers.
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import web
+
+class CachedFile(object):
+    '''The content of a file at a given modification time'''
+
+    def __init__(self, path, mtime, size, data):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.last_modified = datetime.datetime.utcfromtimestamp(int(mtime))
+        self.parsed = {}    # parse function -> value
+        self.lock = threading.Lock()
+
+    def parse(self, function):
+        '''Returns function(self), computed once for this version of the file'''
+        try:
+            return self.parsed[function]
+        except KeyError:
+            pass
+        with self.lock:
+            if function not in self.parsed:
+                self.parsed[function] = function(self)
+            return self.parsed[function]
+
+def parse_json(cached):
+    return json.loads(cached.data)
+
+def compile_template(cached):
+    # As web.template.frender(path)
+    return web.template.Template(cached.data, filename=cached.path)
+
+class FileCache(object):
+
+    def __init__(self):
+        self.files = {}     # path -> CachedFile
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        '''Returns the CachedFile of the current version of a file'''
+        st = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached.mtime == st.st_mtime and cached.size == st.st_size:
+            return cached
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is None or cached.mtime != st.st_mtime or cached.size != st.st_size:
+                f = open(path, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                cached = CachedFile(path, st.st_mtime, st.st_size, data)
+                self.files[path] = cached
+            return cached
+
+    def read(self, path):
+        '''Returns the content of a file'''
+        return self.get(path).data
+
+    def json(self, path):
+        '''Returns the parsed content of a JSON file'''
+        return self.get(path).parse(parse_json)
+
+    def template(self, path):
+        '''Returns a file compiled as a web.py template (as web.template.frender)'''
+        return self.get(path).parse(compile_template)
+
+    def serve(self, path, content_type):
+        '''Returns the content of a file as the response of a web.py handler,
+        or raises web.notmodified if the client already has this version'''
+        cached = self.get(path)
+        web.header('Content-Type', content_type)
+        web.modified(date=cached.last_modified, etag=cached.etag)
+        return cached.data
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
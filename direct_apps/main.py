@@ -12,6 +12,7 @@ import urllib
 import rdflib
 import os
 import sys
+import threading
 
 # Add the current directory to the system path so that python can mod_py could
 # load the local modules
@@ -20,8 +21,8 @@ sys.path.append(abspath)
 
 # Import the local smart client modules and components
 from smart_client import oauth
-from smart_client.smart import SmartClient
 from smart_client.rdf_utils import anonymize_smart_rdf
+from smart_client_pool import SmartClientPool
 
 # Import the local markdown module function
 from lib.markdown2 import markdown
@@ -30,21 +31,43 @@ from lib.markdown2 import markdown
 from StringIO import StringIO
 from sendmail import send_message
 from pdf_writer import generate_pdf
+from filecache import FileCache
+from credential_cache import CredentialCache
+from outbox import Outbox
 
 # Import the application settings
 from settings import APP_PATH, SMTP_HOST, SMTP_USER, SMTP_PASS
 from settings import SMTP_HOST_ALT, SMTP_USER_ALT, SMTP_PASS_ALT
 from settings import PROXY_OAUTH, PROXY_PARAMS, SMART_DIRECT_PREFIX
 
-# Default configuration settings for the SMART client
+# Default configuration settings for the SMART client (the consumer key and
+# the container API base come from the OAuth header of each request)
 SMART_SERVER_OAUTH = {
-#    'consumer_key': 
     'consumer_secret': 'smartapp-secret'
 }
 
-SMART_SERVER_PARAMS = {
-#    'api_base': 
-}
+# SMART clients are reused by the requests made with the same credentials
+client_pool = SmartClientPool()
+
+# The pages and data files are kept in memory (and served with an ETag)
+static_files = FileCache()
+
+# OAuth headers verified in the last CREDENTIALS_TTL seconds are trusted
+# without setting up a SMART client again
+CREDENTIALS_TTL = 300
+verified_credentials = CredentialCache(CREDENTIALS_TTL)
+
+# The record sections that can be sent with a SMART Direct Apps message:
+# API name and SMART client method, in the order they are merged
+RECORD_SECTIONS = [('demographics', 'records_X_demographics_GET'),
+                   ('problems', 'records_X_problems_GET'),
+                   ('medications', 'records_X_medications_GET'),
+                   ('vital_signs', 'records_X_vital_signs_GET')]
+
+# The messages are sent in the background by OUTBOX_WORKERS threads. The
+# queued messages are kept in OUTBOX_DB until they are sent.
+OUTBOX_DB = APP_PATH + '/temp/outbox.db'
+OUTBOX_WORKERS = 2
 
 # URL mappings for web.py
 urls = ('/smartapp/index.html', 'index_apps',
@@ -57,25 +80,20 @@ urls = ('/smartapp/index.html', 'index_apps',
         '/smartapp/getdemographics', 'get_demographics',
         '/smartapp/getuser', 'get_user',
         '/smartapp/sendmail-msg', 'send_msg_message',
-        '/smartapp/sendmail-apps', 'send_apps_message')
+        '/smartapp/sendmail-apps', 'send_apps_message',
+        '/smartapp/sendmail-status', 'send_status')
 
 class index_msg:
     '''Handler for the SMART Direct Messages app page'''
     
     def GET(self):
-        f = open(APP_PATH + '/templates/index-msg.html', 'r')
-        html = f.read()
-        f.close()
-        return html
+        return static_files.serve(APP_PATH + '/templates/index-msg.html', 'text/html')
         
 class index_apps:
     '''Handler for the SMART Direct Applications app page'''
     
     def GET(self):
-        f = open(APP_PATH + '/templates/index-apps.html', 'r')
-        html = f.read()
-        f.close()
-        return html
+        return static_files.serve(APP_PATH + '/templates/index-apps.html', 'text/html')
         
 class get_recipients:
     '''Recipients REST service handler
@@ -84,15 +102,12 @@ class get_recipients:
     '''
     
     def GET(self):
-        # First, try setting up a dummy SMART client to test the credentials
-        # for securty reasons (will raise excepton if the credentails are bad)
-        get_smart_client()
+        # First, test the credentials for securty reasons (will raise
+        # excepton if the credentails are bad)
+        verify_credentials()
     
         # Now process the request
-        f = open(APP_PATH + '/data/addresses.json', 'r')
-        res = f.read()
-        f.close()
-        return res
+        return static_files.serve(APP_PATH + '/data/addresses.json', 'application/json')
         
 class get_apps:
     '''Apps REST service handler
@@ -101,9 +116,9 @@ class get_apps:
     '''
     
     def GET(self):
-        # First, try setting up a dummy SMART client to test the credentials
-        # for securty reasons (will raise excepton if the credentails are bad)
-        get_smart_client()
+        # First, test the credentials for securty reasons (will raise
+        # excepton if the credentails are bad)
+        verify_credentials()
     
         # Now process the request
     
@@ -113,10 +128,7 @@ class get_apps:
         #apps = sorted(apps, key=lambda app: app['name'])
         #return json.dumps(apps)
         
-        f = open(APP_PATH + '/data/apps.json', 'r')
-        res = f.read()
-        f.close()
-        return res
+        return static_files.serve(APP_PATH + '/data/apps.json', 'application/json')
         
 class get_meds:
     '''Medications REST service handler
@@ -127,10 +139,10 @@ class get_meds:
     def GET(self):
     
         #Initialize the SMART client
-        smart_client = get_smart_client()
+        with get_smart_client() as smart_client:
         
-        # Query the SMART server for medications data
-        meds = smart_client.records_X_medications_GET()
+            # Query the SMART server for medications data
+            meds = smart_client.records_X_medications_GET()
         
         q = """
             PREFIX dc:<http://purl.org/dc/elements/1.1/>
@@ -164,10 +176,10 @@ class get_problems:
     def GET(self):
     
         #Initialize the SMART client
-        smart_client = get_smart_client()
+        with get_smart_client() as smart_client:
         
-        # Query the SMART server for medications data
-        problems = smart_client.records_X_problems_GET()
+            # Query the SMART server for medications data
+            problems = smart_client.records_X_problems_GET()
         
         q = """
             PREFIX dc:<http://purl.org/dc/elements/1.1/>
@@ -202,10 +214,10 @@ class get_demographics:
     def GET(self):
     
         #Initialize the SMART client
-        smart_client = get_smart_client()
+        with get_smart_client() as smart_client:
         
-        # Query the SMART server for demographics data
-        demographics = smart_client.records_X_demographics_GET()
+            # Query the SMART server for demographics data
+            demographics = smart_client.records_X_demographics_GET()
         
         q = """
             PREFIX foaf:<http://xmlns.com/foaf/0.1/>
@@ -241,10 +253,10 @@ class get_user:
     def GET(self):
     
         #Initialize the SMART client
-        smart_client = get_smart_client()
+        with get_smart_client() as smart_client:
         
-        # Query the SMART server for user data
-        user = smart_client.users_X_GET()
+            # Query the SMART server for user data
+            user = smart_client.users_X_GET()
         
         q = """
             PREFIX foaf:<http://xmlns.com/foaf/0.1/> 
@@ -275,35 +287,22 @@ class send_msg_message:
     '''
     
     def POST(self): 
-        # First, try setting up a dummy SMART client to test the credentials
-        # for securty reasons (will raise excepton if the credentails are bad)
-        get_smart_client()
+        # First, test the credentials for securty reasons (will raise
+        # excepton if the credentails are bad)
+        verify_credentials()
     
         # Load the message parameters
         me = SMTP_USER + "@" + SMTP_HOST # we always use the primary SMART Direct address
         you = web.input().recipient_email
         subject = web.input().subject
         message = web.input().message
-   
-        # Create the body of the message (plain-text and HTML version).
-        text = message
-        html = markdown(text)
-        
-        # Generate the PDF attachment content
-        pdf_buffer = generate_pdf (html)
         
-        # Initialize the attachment and general settings for the mailer
-        attachments = [{'file_buffer': generate_pdf(html), 'name': "patient.pdf", 'mime': "application/pdf"}]
-        settings = {'host': SMTP_HOST, 'user': SMTP_USER, 'password': SMTP_PASS}
+        # Queue the message (it is rendered and sent by the outbox workers)
+        job = outbox.submit('msg', {'me': me, 'you': you, 'subject': subject, 'text': message},
+                            owner=credentials_owner())
         
-        # Send the SMART Direct message
-        send_message (me, you, subject, text, html, attachments, settings)
-        
-        # Clean up the string buffer
-        pdf_buffer.close()
-        
-        # Respond with success message
-        return json.dumps({'result': 'ok'})
+        # Respond with the id of the job (see send_status)
+        return json.dumps({'result': 'queued', 'job': job})
  
 class send_apps_message:
     '''SMART Direct Applications sender REST service handler
@@ -312,12 +311,9 @@ class send_apps_message:
     '''
     
     def POST(self):
-        # First, try setting up a dummy SMART client to test the credentials
-        # for securty reasons (will raise excepton if the credentails are bad)
-        get_smart_client()
-        
-        # Initialize the SMART client
-        smart_client = get_smart_client()
+        # First, test the credentials for securty reasons (will raise
+        # excepton if the credentails are bad)
+        verify_credentials()
 
         # Load the message parameters
         sender = web.input().sender_email
@@ -331,13 +327,9 @@ class send_apps_message:
         me = SMTP_USER_ALT + "@" + SMTP_HOST_ALT
         you = SMTP_USER + "@" + SMTP_HOST
         
-        # Load the app manifests JSON 
-        FILE = open(APP_PATH + '/data/apps.json', 'r')
-        APPS_JSON = FILE.read()
-        FILE.close()
-        
-        # Parse the apps manifests JSON
-        myapps = json.loads(APPS_JSON)
+        # Load the parsed app manifests JSON (shared with the other
+        # requests: it must not be modified)
+        myapps = static_files.json(APP_PATH + '/data/apps.json')
         
         # Initialize the outbound manifest data object
         manifest= {"from": sender,
@@ -353,80 +345,191 @@ class send_apps_message:
                 for i in myapis:
                     if (i not in apis):
                         apis.append(i)
-                del(a['apis'])
-                del(a['name'])
-                del(a['icon'])
+                a = dict((k, v) for k, v in a.items() if k not in ('apis', 'name', 'icon'))
                 manifest["apps"].append(a)
         
-        # Load the manifest in a string buffer (in JSON format)
+        # Serialize the manifest (in JSON format)
         manifesttxt = json.dumps(manifest)
-        manifestbuffer = StringIO()
-        manifestbuffer.write(manifesttxt)
-        
-        # Build the patient RDF graph
-        rdfres = smart_client.records_X_demographics_GET()
         
-        if ("problems" in apis):
-            rdfres += smart_client.records_X_problems_GET()
-            
-        if ("medications" in apis):
-            rdfres += smart_client.records_X_medications_GET()
-            
-        if ("vital_signs" in apis):
-            rdfres += smart_client.records_X_vital_signs_GET() 
+        # Build the patient RDF graph: the demographics and the sections
+        # needed by the selected apps are fetched at the same time, then
+        # merged
+        methods = [method for api, method in RECORD_SECTIONS
+                   if api == "demographics" or api in apis]
+        graphs = fetch_record_sections(methods)
+        rdfres = graphs[0]
+        for graph in graphs[1:]:
+            rdfres += graph
         
         # Anonymize the RDF graph for export
         rdfres = anonymize_smart_rdf (rdfres)
         
-        # Serialize the RDF graph in a string buffer
+        # Serialize the RDF graph
         rdftext = rdfres.serialize()
-        rdfbuffer = StringIO()
-        rdfbuffer.write(rdftext)
         
-        # Initialize the attachments descriptor object
-        attachments = [
-            {'file_buffer': rdfbuffer, 'name': "patient.xml", 'mime': "text/xml"},
-            {'file_buffer': manifestbuffer, 'name': "manifest.json", 'mime': "text/xml"}
-        ]
+        # Queue the message (it is sent by the outbox workers)
+        job = outbox.submit('apps', {'me': me, 'you': you, 'subject': subject, 'message': message,
+                                     'rdftext': rdftext, 'manifesttxt': manifesttxt},
+                            owner=credentials_owner())
         
-        # Initialize the mailer settings
-        settings = {'host': SMTP_HOST_ALT, 'user': SMTP_USER_ALT, 'password': SMTP_PASS_ALT}
+        # Respond with the id of the job (see send_status)
+        return json.dumps({'result': 'queued', 'job': job})
         
-        # Send the SMART Direct message
-        send_message (me, you, subject, message, message, attachments, settings)
+class send_status:
+    '''SMART Direct message status REST service handler
+    
+    Returns the state of a message queued by sendmail-msg or sendmail-apps
+    in JSON format: queued, sending, sent or failed
+    '''
+    
+    def GET(self):
+        # First, test the credentials for securty reasons (will raise
+        # excepton if the credentails are bad)
+        verify_credentials()
         
-        # Clean up the string buffers
-        manifestbuffer.close()
-        rdfbuffer.close()
+        # Only the jobs queued with the same credentials can be seen
+        status = outbox.status(web.input().job, owner=credentials_owner())
+        if status is None:
+            raise web.notfound()
         
-        # Respond with success message
-        return json.dumps({'result': 'ok'})
+        return json.dumps({'job': status['job'], 'status': status['status'],
+                           'error': status['error'] and status['error'].strip().splitlines()[-1]})
         
+def send_msg_job(job):
+    '''Renders and sends a message queued by send_msg_message'''
+    
+    # Create the body of the message (plain-text and HTML version).
+    text = job['text']
+    html = markdown(text)
+    
+    # Generate the PDF attachment content
+    pdf_buffer = generate_pdf (html)
+    
+    # Initialize the attachment and general settings for the mailer
+    attachments = [{'file_buffer': pdf_buffer, 'name': "patient.pdf", 'mime': "application/pdf"}]
+    settings = {'host': SMTP_HOST, 'user': SMTP_USER, 'password': SMTP_PASS}
+    
+    # Send the SMART Direct message
+    send_message (job['me'], job['you'], job['subject'], text, html, attachments, settings)
+    
+    # Clean up the string buffer
+    pdf_buffer.close()
+    
+def send_apps_job(job):
+    '''Sends a message queued by send_apps_message'''
+    
+    # Load the RDF graph and the manifest in string buffers
+    rdfbuffer = StringIO()
+    rdfbuffer.write(job['rdftext'])
+    manifestbuffer = StringIO()
+    manifestbuffer.write(job['manifesttxt'])
+    
+    # Initialize the attachments descriptor object
+    attachments = [
+        {'file_buffer': rdfbuffer, 'name': "patient.xml", 'mime': "text/xml"},
+        {'file_buffer': manifestbuffer, 'name': "manifest.json", 'mime': "text/xml"}
+    ]
+    
+    # Initialize the mailer settings
+    settings = {'host': SMTP_HOST_ALT, 'user': SMTP_USER_ALT, 'password': SMTP_PASS_ALT}
+    
+    # Send the SMART Direct message
+    send_message (job['me'], job['you'], job['subject'], job['message'], job['message'],
+                  attachments, settings)
+    
+    # Clean up the string buffers
+    manifestbuffer.close()
+    rdfbuffer.close()
+        
+def fetch_record_sections(methods):
+    '''Calls the given SMART client methods (e.g. records_X_problems_GET),
+    each in its own thread and with its own SMART client, and returns their
+    results in the same order. Raises the first exception raised by a call.
+    '''
+    oa_params = get_oauth_params()  # web.ctx is not shared with the threads
+    results = [None] * len(methods)
+    errors = [None] * len(methods)
+    
+    def fetch(i, method):
+        try:
+            with smart_client_for(oa_params) as smart_client:
+                results[i] = getattr(smart_client, method)()
+        except Exception:
+            errors[i] = sys.exc_info()
+    
+    threads = [threading.Thread(target=fetch, args=(i, method))
+               for i, method in enumerate(methods)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
 def get_smart_client():
-    '''Initializes and returns a new SMART Client
+    '''Returns a SMART Client from the client pool, to be used in a with
+    statement
     
     Expects an OAUTH header as a REST parameter
     '''
-    smart_oauth_header = web.input().oauth_header
-    smart_oauth_header = urllib.unquote(smart_oauth_header)
-    oa_params = oauth.parse_header(smart_oauth_header)
-    SMART_SERVER_PARAMS['api_base'] = oa_params['smart_container_api_base']
-    SMART_SERVER_OAUTH['consumer_key'] = oa_params['smart_app_id']
+    return smart_client_for(get_oauth_params())
 
-    oa_params = oauth.parse_header(smart_oauth_header)
-    
+def smart_client_for(oa_params):
+    '''Returns a SMART Client from the client pool for the given parsed
+    OAUTH header, to be used in a with statement
+    '''
     resource_tokens={'oauth_token':       oa_params['smart_oauth_token'],
                      'oauth_token_secret':oa_params['smart_oauth_token_secret']}
 
-    ret = SmartClient(SMART_SERVER_OAUTH['consumer_key'], 
-                       SMART_SERVER_PARAMS, 
-                       SMART_SERVER_OAUTH, 
-                       resource_tokens)
-                       
-    ret.record_id=oa_params['smart_record_id']
-    ret.user_id=oa_params['smart_user_id']
-    
-    return ret
+    return client_pool.client(oa_params['smart_container_api_base'],
+                              oa_params['smart_app_id'],
+                              SMART_SERVER_OAUTH['consumer_secret'],
+                              resource_tokens,
+                              record_id=oa_params['smart_record_id'],
+                              user_id=oa_params['smart_user_id'])
+
+def verify_credentials():
+    '''Tests the credentials of the request by setting up a SMART client
+    (raises an exception if they are bad). Credentials verified in the last
+    CREDENTIALS_TTL seconds are not tested again.
+    '''
+    header = get_oauth_header()
+    if verified_credentials.get(header) is not None:
+        return
+    with get_smart_client():
+        pass
+    verified_credentials.add(header, get_oauth_params())
+
+def credentials_owner():
+    '''Returns the owner of the jobs queued by the request (a hash of its
+    OAUTH header)
+    '''
+    return verified_credentials.key(get_oauth_header())
+
+def get_oauth_header():
+    '''Returns the OAUTH header REST parameter of the request'''
+    if 'smart_oauth_header' not in web.ctx:
+        web.ctx.smart_oauth_header = urllib.unquote(web.input().oauth_header)
+    return web.ctx.smart_oauth_header
+
+def get_oauth_params():
+    '''Returns the parsed OAUTH header of the request. The header is parsed
+    once per request, and not at all if it was verified recently.
+    '''
+    if 'smart_oauth_params' not in web.ctx:
+        header = get_oauth_header()
+        oa_params = verified_credentials.get(header)
+        if oa_params is None:
+            oa_params = oauth.parse_header(header)
+        web.ctx.smart_oauth_params = oa_params
+    return web.ctx.smart_oauth_params
+
+# Start sending the queued messages
+outbox = Outbox(OUTBOX_DB, {'msg': send_msg_job, 'apps': send_apps_job}, OUTBOX_WORKERS)
+outbox.start()
 
 # Initialize web.py
 web.config.debug=False
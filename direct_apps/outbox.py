@@ -0,0 +1,184 @@
+'''SMART Direct Apps outbound message queue'''
+# The Direct messages are not sent while the HTTP request that asks for
+# them waits: the request handler only adds a job to the outbox and
+# returns its id. A pool of background threads takes the jobs in order,
+# renders the messages and sends them. The state of each job can be polled
+# with its id: 'queued', 'sending', 'sent' or 'failed' (with the error).
+#
+# The jobs are kept in a SQLite database, so the messages that were queued
+# but not sent yet are not lost if the server stops: they are sent once
+# the outbox is started again. A job that fails is tried again up to
+# max_attempts times, retry_delay seconds apart.
+#
+# Several processes (e.g. the processes of a WSGI server) can share the
+# database: a job is claimed with a conditional update, so it is sent by
+# one worker only. A job that has been 'sending' for more than
+# sending_timeout seconds is assumed to belong to a process that stopped
+# while sending it, and is claimed again.
+#
+#     outbox = Outbox(APP_PATH + '/temp/outbox.db', {'msg': send_msg})
+#     outbox.start()
+#     job_id = outbox.submit('msg', {'to': ..., ...})
+#     outbox.status(job_id)
+#
+# The handler of a kind of job is called with the payload given to submit
+# (anything that can be pickled) from one of the worker threads.
+
+import cPickle as pickle
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id          TEXT PRIMARY KEY,
+        kind        TEXT NOT NULL,
+        payload     BLOB NOT NULL,
+        owner       TEXT,
+        status      TEXT NOT NULL,
+        attempts    INTEGER NOT NULL DEFAULT 0,
+        error       TEXT,
+        created     REAL NOT NULL,
+        not_before  REAL NOT NULL,
+        updated     REAL NOT NULL
+    )
+    """
+
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS outbox_queue ON outbox (status, not_before)"
+
+class Outbox(object):
+
+    def __init__(self, dbfile, handlers, workers=2, max_attempts=3, retry_delay=60,
+                 sending_timeout=600):
+        '''handlers maps the kinds of jobs to the functions that run them'''
+        self.dbfile = dbfile
+        self.handlers = handlers
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sending_timeout = sending_timeout
+        self.threads = []
+        self.lock = threading.Lock()        # serializes the claims of jobs
+        self.wakeup = threading.Condition()
+        db = self.connect()
+        try:
+            db.execute(CREATE_TABLE)
+            db.execute(CREATE_INDEX)
+            db.commit()
+        finally:
+            db.close()
+
+    def connect(self):
+        # One connection per operation: sqlite3 connections cannot be
+        # shared by threads
+        return sqlite3.connect(self.dbfile, timeout=30)
+
+    def start(self):
+        '''Starts the worker threads'''
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='outbox-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, kind, payload, owner=None):
+        '''Queues a job and returns its id. owner (e.g. a hash of the
+        credentials of the request) is kept with the job for status().'''
+        if kind not in self.handlers:
+            raise ValueError("Unknown kind of job: %s" % kind)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute("INSERT INTO outbox (id, kind, payload, owner, status, created, not_before, updated) "
+                       "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                       (job_id, kind, buffer(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)),
+                        owner, now, now, now))
+            db.commit()
+        finally:
+            db.close()
+        with self.wakeup:
+            self.wakeup.notify()
+        return job_id
+
+    def status(self, job_id, owner=None):
+        '''Returns {'job', 'status', 'attempts', 'error'} for a job, or None
+        if there is no such job (or if it has another owner)'''
+        db = self.connect()
+        try:
+            row = db.execute("SELECT status, attempts, error, owner FROM outbox WHERE id = ?",
+                             (job_id,)).fetchone()
+        finally:
+            db.close()
+        if row is None or row[3] != owner:
+            return None
+        return {'job': job_id, 'status': row[0], 'attempts': row[1], 'error': row[2]}
+
+    def work(self):
+        while True:
+            job = self.claim()
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(1.0)
+                continue
+            job_id, kind, payload, attempts = job
+            try:
+                self.handlers[kind](pickle.loads(str(payload)))
+            except Exception:
+                self.failed(job_id, attempts, traceback.format_exc())
+            else:
+                self.finish(job_id, 'sent', None)
+
+    def claim(self):
+        # Takes the oldest job that is due (or whose sender stopped) and
+        # marks it as being sent. The update only succeeds if the job was
+        # not claimed by another process since it was read.
+        with self.lock:
+            db = self.connect()
+            try:
+                while True:
+                    now = time.time()
+                    row = db.execute("SELECT id, kind, payload, attempts, status, updated FROM outbox "
+                                     "WHERE (status = 'queued' AND not_before <= ?) "
+                                     "OR (status = 'sending' AND updated < ?) "
+                                     "ORDER BY created LIMIT 1",
+                                     (now, now - self.sending_timeout)).fetchone()
+                    if row is None:
+                        return None
+                    claimed = db.execute("UPDATE outbox SET status = 'sending', attempts = attempts + 1, "
+                                         "updated = ? WHERE id = ? AND status = ? AND updated = ?",
+                                         (now, row[0], row[4], row[5])).rowcount
+                    db.commit()
+                    if claimed:
+                        return row[0], row[1], row[2], row[3] + 1
+            finally:
+                db.close()
+
+    def failed(self, job_id, attempts, error):
+        print "Unable to send outbox job", job_id
+        print error
+        if attempts < self.max_attempts:
+            db = self.connect()
+            try:
+                db.execute("UPDATE outbox SET status = 'queued', error = ?, not_before = ?, updated = ? "
+                           "WHERE id = ?", (error, time.time() + self.retry_delay, time.time(), job_id))
+                db.commit()
+            finally:
+                db.close()
+        else:
+            self.finish(job_id, 'failed', error)
+
+    def finish(self, job_id, status, error):
+        db = self.connect()
+        try:
+            # The payload of a finished job is not needed any more
+            db.execute("UPDATE outbox SET status = ?, error = ?, payload = ?, updated = ? WHERE id = ?",
+                       (status, error, buffer(''), time.time(), job_id))
+            db.commit()
+        finally:
+            db.close()
@@ -19,6 +19,7 @@ import web
 from email.parser import FeedParser
 from StringIO import StringIO
 from sendmail import send_message
+from filecache import FileCache
 
 # Import the local library modules classes and methods
 from lib.html2text import html2text
@@ -32,6 +33,9 @@ from settings import SMTP_HOST_ALT, SMTP_USER_ALT, SMTP_PASS_ALT
 from settings import PROXY_OAUTH, PROXY_PARAMS, BACKGROUND_OAUTH, BACKGROUND_PARAMS
 from settings import SMART_DIRECT_PREFIX
 
+# The app manifests and the message templates are kept in memory
+static_files = FileCache()
+
 def generate_pin ():
     '''Returns a random PIN number in the range [1000-9999]'''
     pin = str(random.randint(1000, 9999))
@@ -104,21 +108,17 @@ def get_updated_messages(note, accessURL, manifestStr, pin):
     html = ""
     text = ""
 
-    # Load the SMART apps' manifests
-    FILE = open(APP_PATH + '/data/apps.json', 'r')
-    APPS_JSON = FILE.read()
-    FILE.close()
-    
-    # Parse the apps list and build anew list containing only
-    # the manifest details of the apps needed for this message
-    apps = json.loads(APPS_JSON)
+    # Load the parsed SMART apps' manifests, then build a new list
+    # containing only the manifest details of the apps needed for this
+    # message
+    apps = static_files.json(APP_PATH + '/data/apps.json')
     manifest = json.loads(manifestStr)
     myapps = [x['id'] for x in manifest['apps']]
     apps_out = [a for a in apps if a['id'] in myapps]
 
     # Build the final messages from the templates
-    template_html = web.template.frender(APP_PATH + '/templates/message-apps.html')
-    template_text = web.template.frender(APP_PATH + '/templates/message-apps.txt')
+    template_html = static_files.template(APP_PATH + '/templates/message-apps.html')
+    template_text = static_files.template(APP_PATH + '/templates/message-apps.txt')
     html = template_html(note, str(pin), accessURL, apps_out)
     text = template_text(remove_html_tags(note), str(pin), accessURL, apps_out)
     
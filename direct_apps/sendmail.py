@@ -7,6 +7,12 @@
 # Import smtplib for the actual sending function
 import smtplib
 
+# Import the modules used by the SMTP session pool
+import hashlib
+import socket
+import threading
+import time
+
 # Import various email module components
 from email import encoders
 from email.header import Header
@@ -15,9 +21,9 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 
-def send_message (from_, to, subject, text, html, attachments, settings, from_name = 'SMART Direct'): 
-    '''Generates and sends out a proper multipart email message
-       with the supplied parameters over SMPTS (secure SMTP)
+def build_message (from_, to, subject, text, html, attachments, from_name = 'SMART Direct'):
+    '''Generates a proper multipart email message with the supplied
+       parameters
     '''
 
     # Record the MIME types of both parts - text/plain and text/html.
@@ -55,10 +61,122 @@ def send_message (from_, to, subject, text, html, attachments, settings, from_na
         msg.add_header('Content-Disposition', 'attachment', filename=a['name'])
         outer.attach(msg)
     
-    # Send the message via SMTPS
-    user = settings['user']
-    password = settings['password']
-    s = smtplib.SMTP_SSL(settings['host'])
-    s.login(user, password)
-    s.sendmail(from_, [to], outer.as_string())
-    s.close()
\ No newline at end of file
+    return outer
+
+def send_message (from_, to, subject, text, html, attachments, settings, from_name = 'SMART Direct'): 
+    '''Generates and sends out a proper multipart email message
+       with the supplied parameters over SMPTS (secure SMTP)
+    '''
+    outer = build_message (from_, to, subject, text, html, attachments, from_name)
+    send_messages ([(from_, to, outer)], settings)
+
+def send_messages (messages, settings):
+    '''Sends out a batch of (from, to, message) over one SMTP session.
+       The messages are email.Message objects (see build_message) or
+       strings.
+    '''
+    smtp_pool.send(settings, [(from_, [to], msg if isinstance(msg, basestring) else msg.as_string())
+                              for from_, to, msg in messages])
+
+class SMTPPool(object):
+    '''Pool of authenticated SMTP sessions
+
+    Opening a session costs a TCP connection, a TLS handshake and a login,
+    so the sessions are kept open after sending and reused by the next
+    messages sent with the same settings. The settings are the dictionaries
+    given to send_message: 'host', 'user' and 'password', and optionally
+    'port' (default: 465 with SSL, 25 without) and 'ssl' (default: True).
+    No login is made when 'user' is empty (e.g. with a local test server).
+
+    A session is used by one sender at a time. A session that has been idle
+    for more than max_idle_time seconds is closed instead of reused. If the
+    server has closed an idle session, the message is sent again over a new
+    one; the sessions that fail otherwise are dropped.
+    '''
+
+    def __init__(self, max_idle_per_key=2, max_idle_time=120):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_idle_time = max_idle_time
+        self.idle = {}      # key -> [(session, last used)]
+        self.lock = threading.Lock()
+
+    def key(self, settings):
+        # Only the hash of the password is kept in the key
+        return (settings['host'], settings.get('port', 0), settings.get('ssl', True),
+                settings.get('user'), hashlib.sha1(settings.get('password') or '').hexdigest())
+
+    def connect(self, settings):
+        if settings.get('ssl', True):
+            session = smtplib.SMTP_SSL(settings['host'], settings.get('port', 0))
+        else:
+            session = smtplib.SMTP(settings['host'], settings.get('port', 0))
+        if settings.get('user'):
+            session.login(settings['user'], settings['password'])
+        return session
+
+    def checkout(self, key):
+        now = time.time()
+        expired = []
+        session = None
+        with self.lock:
+            sessions = self.idle.get(key, [])
+            while sessions and session is None:
+                session, used = sessions.pop()
+                if now - used > self.max_idle_time:
+                    expired.append(session)
+                    session = None
+        for s in expired:
+            self.discard(s)
+        return session
+
+    def checkin(self, key, session):
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if len(sessions) < self.max_idle_per_key:
+                sessions.append((session, time.time()))
+                return
+        self.discard(session)
+
+    def discard(self, session):
+        try:
+            session.quit()
+        except (smtplib.SMTPException, socket.error):
+            session.close()
+
+    def send(self, settings, messages):
+        '''Sends a batch of (from, [to, ...], message string) over one
+           session
+        '''
+        key = self.key(settings)
+        session = self.checkout(key)
+        reused = session is not None
+        if not reused:
+            session = self.connect(settings)
+        try:
+            for from_, to, msg in messages:
+                try:
+                    session.sendmail(from_, to, msg)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    if not reused:
+                        raise
+                    # The server closed the session while it was idle
+                    self.discard(session)
+                    session = None
+                    session = self.connect(settings)
+                    session.sendmail(from_, to, msg)
+                reused = False
+        except:
+            if session is not None:
+                self.discard(session)
+            raise
+        self.checkin(key, session)
+
+    def clear(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s, used in idle]
+            self.idle.clear()
+        for s in sessions:
+            self.discard(s)
+
+# The SMTP sessions are kept open and shared by all the senders
+smtp_pool = SMTPPool()
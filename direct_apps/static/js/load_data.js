@@ -180,4 +180,39 @@ if (!DIRECT) {
         });
         return dfd.promise();
     };
+
+    /**
+    * Waits for a message queued by sendmail-msg or sendmail-apps to be sent
+    * (the id of the job is in the response of the sendmail call). Polls
+    * sendmail-status until the message is sent (resolved) or failed (rejected
+    * with the error).
+    */
+    DIRECT.waitForJob = function (job) {
+        var dfd = $.Deferred(),
+            poll = function () {
+                $.ajax({
+                    url: "sendmail-status",
+                    data: {'job': job, 'oauth_header': SMART.credentials.oauth_header},
+                    dataType: "html",
+                    cache: false,
+                    success: function (responseText) {
+                        var data = JSON.parse(responseText);
+                        if (data.status === "sent") {
+                            dfd.resolve();
+                        } else if (data.status === "failed") {
+                            console.error("job " + job + " failed: " + data.error);
+                            dfd.reject(data.error);
+                        } else {
+                            setTimeout(poll, 1000);
+                        }
+                    },
+                    error: function () {
+                        console.error("sendmail-status failed");
+                        dfd.reject();
+                    }
+                });
+            };
+        poll();
+        return dfd.promise();
+    };
 }());
\ No newline at end of file
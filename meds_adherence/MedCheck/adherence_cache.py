@@ -0,0 +1,201 @@
+
+# Imports
+import hashlib
+import os
+import threading
+import time
+import cPickle as pickle
+from collections import OrderedDict
+from django.conf import settings
+
+
+"""
+File: adherence_cache.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Cache for the results of adherence_check.all_tests. Entries
+    are keyed by the patient record id and a fingerprint of the medication
+    fulfillments, so a result is reused until the patient's medication data
+    changes, and two clinicians looking at different patients do not evict
+    each other's results.
+
+    The backend is chosen by settings.ADHERENCE_CACHE['BACKEND']:
+        'locmem'  in-process LRU cache (default)
+        'django'  the Django cache framework (settings.CACHES)
+        'file'    pickled entries in the LOCATION directory
+    MAX_ENTRIES bounds the number of entries kept and TIMEOUT (seconds) the
+    time an entry is considered valid.
+
+    The cache also remembers, for each record and access token, which entry
+    was computed last and when its fulfillments were fetched, so that the
+    drill-down pages can be served without contacting the container as long
+    as this is less than STALE_AFTER seconds old.
+
+"""
+def cache_key(record_id, pills):
+    """ Returns the cache key of a patient record for the given medication
+    fulfillments, the rows of (med, name, quant, when) used by gap_check."""
+    fills = sorted(u"%s|%s|%s" % (pill[1], pill[2], pill[3]) for pill in pills)
+    h = hashlib.sha1(unicode(record_id).encode('utf-8'))
+    for fill in fills:
+        h.update('\n' + fill.encode('utf-8'))
+    return 'medcheck-adherence-' + h.hexdigest()
+
+def lookup(key):
+    """ Returns the cached adherence result for key, or None."""
+    return get_cache().get(key)
+
+def store(key, value):
+    """ Stores the adherence result for key."""
+    get_cache().set(key, value)
+
+def record_key(api_base, record_id, oauth_token):
+    """ Returns the key of the latest result of a record, as seen with the
+    given access token. The token is part of the key so that a result is only
+    served without the container to the session that fetched it."""
+    h = hashlib.sha1(u"\n".join([api_base, record_id, oauth_token]).encode('utf-8'))
+    return 'medcheck-adherence-record-' + h.hexdigest()
+
+def latest_key(rkey):
+    """ Returns the key of the latest adherence result of a record, or None
+    if there is none or if its fulfillments were fetched more than
+    STALE_AFTER seconds ago."""
+    entry = get_cache().get(rkey)
+    if entry is None:
+        return None
+    key, fetched_at = entry
+    if fetched_at + stale_after() < time.time():
+        return None
+    return key
+
+def stale_after():
+    return getattr(settings, 'ADHERENCE_CACHE', {}).get('STALE_AFTER', 300)
+
+def store_record(rkey, key):
+    """ Records that key is the latest result of a record, computed from
+    fulfillments fetched now."""
+    get_cache().set(rkey, (key, time.time()))
+
+
+class LocMemCache():
+    """ Least recently used cache in the memory of this process."""
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.entries = OrderedDict()   # key -> (expires, value), oldest first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < now:
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.timeout, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DjangoCache():
+    """ Adapter for the Django cache framework, which does its own eviction."""
+
+    def __init__(self, max_entries, timeout):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+
+class FileCache():
+    """ One pickle file per entry. The modification time of a file is its
+    last use, which is used for both expiry and LRU eviction."""
+
+    def __init__(self, max_entries, timeout, location):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.location = location
+        if not os.path.isdir(location):
+            os.makedirs(location)
+
+    def get(self, key):
+        filename = os.path.join(self.location, key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            expires, value = pickle.load(f)
+        except Exception:
+            return None
+        finally:
+            f.close()
+        if expires < time.time():
+            self._remove(filename)
+            return None
+        os.utime(filename, None)
+        return value
+
+    def set(self, key, value):
+        filename = os.path.join(self.location, key)
+        tmpname = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+        f = open(tmpname, 'wb')
+        try:
+            pickle.dump((time.time() + self.timeout, value), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+        self._cull()
+
+    def _cull(self):
+        names = [n for n in os.listdir(self.location) if not n.endswith('.tmp')]
+        if len(names) <= self.max_entries:
+            return
+        files = [os.path.join(self.location, n) for n in names]
+        files.sort(key=os.path.getmtime)
+        for filename in files[:len(files) - self.max_entries]:
+            self._remove(filename)
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """ Returns the cache backend configured in settings.ADHERENCE_CACHE."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = getattr(settings, 'ADHERENCE_CACHE', {})
+            backend = config.get('BACKEND', 'locmem')
+            max_entries = config.get('MAX_ENTRIES', 200)
+            timeout = config.get('TIMEOUT', 3600)
+            if backend == 'locmem':
+                _cache = LocMemCache(max_entries, timeout)
+            elif backend == 'django':
+                _cache = DjangoCache(max_entries, timeout)
+            elif backend == 'file':
+                _cache = FileCache(max_entries, timeout, config['LOCATION'])
+            else:
+                raise ValueError("Unknown adherence cache backend: %s" % backend)
+        return _cache
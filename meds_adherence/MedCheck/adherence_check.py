@@ -1,11 +1,31 @@
 
 # Imports
 import gap_check as gap
+import drug_classes
+import drug_state
+import med_parser
+import rdflib
 from django.conf import settings
-import xlrd
 
 # Global variables
 ISO_8601_DATETIME = '%Y-%m-%d'
+MEDICATIONS_PATH = '/records/%s/medications/'
+
+# The medication fulfillments: one (med, name, quant, when) row per fill
+FULFILLMENT_QUERY = """
+    PREFIX dcterms:<http://purl.org/dc/terms/>
+    PREFIX sp:<http://smartplatforms.org/terms#>
+    PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+    SELECT  ?med ?name ?quant ?when
+    WHERE {
+        ?med rdf:type sp:Medication .
+        ?med sp:drugName ?medc.
+        ?medc dcterms:title ?name.
+        ?med sp:fulfillment ?fill.
+        ?fill sp:dispenseDaysSupply ?quant.
+        ?fill dcterms:date ?when.
+   }
+   """
 
 
 """    
@@ -21,28 +41,68 @@ File: adherence_check.py
 
 """
 
-# TODO: This needs to be re-organized. Gap check, logistic prediction should
-# be called as two med adherence checks, with the possibility of adding more
-# in the future.
-def all_tests(patient_refill_data, drug, birthday):
+def all_tests(patient_refill_data, drug, birthday, series=None, timings=None, pool=None):
+    # Runs the adherence tests registered in adherence_tests.py (gap check,
+    # mpr threshold, logistic prediction, ...) on every drug. See
+    # gap_check for timings and pool.
     
     drug_class_data = settings.MEDIA_ROOT + "drugClass.xls"
-    drugclass = get_drug_class(drug_class_data)
-    gap_flag, gaps, mpr_tseries, refill_day, actualMPR = gap.gap_check(patient_refill_data, drug, birthday, drugclass)
+    drugclass = drug_classes.get_drug_classes(drug_class_data)
+    gap_flag, gaps, mpr_tseries, refill_day, actualMPR = gap.gap_check(patient_refill_data, drug, birthday, drugclass,
+                                                                       series, timings, pool)
                        
     return gap_flag, gaps, mpr_tseries, refill_day, actualMPR
 
+def incremental_tests(patient_refill_data, drug, birthday, states):
+    # The flags of all_tests, computed by extending the drug states of a
+    # previous run (see drug_state.py). Returns (gap_flag, new states).
+    drug_class_data = settings.MEDIA_ROOT + "drugClass.xls"
+    drugclass = drug_classes.get_drug_classes(drug_class_data)
+    return drug_state.incremental_check(patient_refill_data, drug, birthday, drugclass, states)
+
+def risk_series(adhere_vars, drug='all'):
+    # The series plotted in the risk page (see views.risk_json), from the
+    # result of all_tests, for one drug or for 'all' of them:
+    #     {drug name: {"refill": [...], "gaps": [...], "refill_day": [...],
+    #                  "mpr": [...]}}
+    gap_flag, gaps, mpr_tseries, refill_day, actualMPR = adhere_vars
+    if drug == 'all':
+        names = actualMPR.keys()
+    else:
+        names = [name for name in actualMPR.keys() if name == drug]
+    series = {}
+    for name in names:
+        series[name] = {'refill': mpr_tseries[name],
+                        'gaps': gaps[name],
+                        'refill_day': refill_day[name],
+                        'mpr': actualMPR[name]}
+    return series
+
+def get_fulfillments(medications):
+    # The (med, name, quant, when) rows of the medications RDF graph
+    return list(medications.query(FULFILLMENT_QUERY))
+
+def fetch_fulfillments(client):
+    # Get the medication list of the client's record as RDF/XML and
+    # extract its fulfillments
+    return parse_fulfillments(client.get(MEDICATIONS_PATH % client.record_id))
+
+def parse_fulfillments(rdfxml):
+    # The (med, name, quant, when) rows of the medications RDF/XML, as
+    # unicode strings. The document is streamed by med_parser; the rdflib
+    # graph and the SPARQL query are only used for the shapes med_parser
+    # does not know.
+    pills = med_parser.parse_fulfillments(rdfxml)
+    if pills is None:
+        medications = rdflib.ConjunctiveGraph()
+        medications.parse(data=rdfxml, format="xml")
+        pills = [tuple(unicode(x) for x in pill) for pill in get_fulfillments(medications)]
+    return pills
+
 def get_drug_class(drugclassfilename):
-    # Connect to or read drug class information
-    drugclass = {}
-    wb = xlrd.open_workbook(drugclassfilename)  # Excel workbook
-    sh = wb.sheet_by_index(0)                   # first sheet
-    # Iterate through the rows, reading lines containing drugname, class
-    for rownum in range(sh.nrows):
-        row = sh.row_values(rownum) # row[0]=drugname, row[1]=class
-        drugclass[row[0]] = row[1]
-        
-    return drugclass
+    # Connect to or read drug class information. The spreadsheet is only
+    # read once per process (see drug_classes.py).
+    return drug_classes.get_drug_classes(drugclassfilename)
 
         # Get the drug class information from REST calls to ndf_rt
         #base_url = 'http://rxnav.nlm.nih.gov/REST/Ndfrt'
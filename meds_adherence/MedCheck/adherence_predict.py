@@ -2,6 +2,13 @@
 # Imports
 import readTable
 import math
+import drug_names
+import os
+import threading
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from xml.dom.minidom import parseString
 
 # Global variables
@@ -25,14 +32,10 @@ class adherence_predict():
     
     def __init__(self, modelfilename, drugclasses):
         
-        # Get the data table from the given regression file
-        try:
-            reader = readTable.readTable(modelfilename)
-            print "read from: ", modelfilename
-        except:
-            print "Can't open file ", modelfilename
-            return
-        self.data = reader.read()        
+        # Get the regression coefficients from the given regression file.
+        # The file is only read and parsed once per process.
+        self.model = get_model(modelfilename)
+        self.data = self.model.table
         self.drugclasses = drugclasses
 
     
@@ -44,45 +47,112 @@ class adherence_predict():
     # is binary: 0 = no problem, 1 = non-adherence (mpr < 0.8) predicted
     # at 1 year from first fill.
     def predict(self, med_name, age, mpr, iday):
+        return self.predict_many([(med_name, age, mpr, iday)])[0]
+
+    # Same as predict, for a list of (med_name, age, mpr, iday) rows. All
+    # the rows are scored with a single evaluation of the logit function.
+    def predict_many(self, rows):
         
-        # Initialize to null. This is the default case if none of the given
-        # input parameters match the valid model parameters.
-        # Some local variables
-        adherence_warning = 0   # By default, no warning is reported
-        sday = str(iday)
-        allowable_days = ['60', '90', '120']
-        
-        # Get the drug class from the drug name
-        
-        # Is the med_name in the list of model_class names?
-        name = med_name.split()[0].lower()
+        # By default, no warning is reported. Rows for drugs that are not
+        # in one of the model classes get -1: no prediction.
+        warnings = [0] * len(rows)
+        scored = []
+        for i, (med_name, age, mpr, iday) in enumerate(rows):
         
-        #print "Prediction name :", name
+            # Is the med_name in the list of model_class names?
+            drug_class = drug_names.drug_class(med_name, self.drugclasses)
+            if drug_class is None:
+                warnings[i] = -1  # no prediction
+                continue
+            drug_class = str(drug_class)
+            if not self.model.has_class(drug_class):
+                warnings[i] = -1  # no model for this drug class
+                continue
+            
+            if not self.model.has_day(iday):
+                print "day not allowable for adherence calculation"
+                continue
+            scored.append((i, drug_class, age, mpr, iday))
         
-        if self.drugclasses.has_key(name):
-            drug_class = str(self.drugclasses[name])
-        else:
-            drug_class = "other"
-            return -1  # no prediction
-                
-        if not (sday in allowable_days):
-            print "day not allowable for adherence calculation"
-            return adherence_warning
-                
-        # Set up the regression coefficients. Age must be 60, 90 or 120 days
-        # at this time.
-        #print "2. med, class: ", name, drug_class
-        #print "keys:", self.data.keys()
-        coeff = self.data[drug_class][sday]
-        a = float(coeff[0])
-        b = float(coeff[1])
-        c = float(coeff[2])
-                
-        # Compute the logit function
-        g = a + b*mpr + c*age
-        exp_g = math.exp(g)
-        p = exp_g/(1.0 + exp_g)
-        if p > 0.5: adherence_warning = 1
+        if scored:
+            index, classes, ages, mprs, days = zip(*scored)
+            p = self.model.probability(classes, ages, mprs, days)
+            for i, pi in zip(index, p):
+                if pi > 0.5: warnings[i] = 1
                                 
-        return adherence_warning
-    
\ No newline at end of file
+        return warnings
+
+
+class LogisticModel():
+    """ The coefficients of the logistic regression models: for each drug
+    class and prediction day, g = a + b*mpr + c*age and the probability of
+    non-adherence is exp(g)/(1 + exp(g))."""
+
+    def __init__(self, table):
+        # table[drug_class][day] = [a, b, c], as read by readTable. Lines
+        # without numeric coefficients (the column labels) are skipped.
+        self.table = table
+        self.classes = {}
+        self.days = {}
+        coeffs = {}
+        for drug_class in sorted(table.keys()):
+            for sday in table[drug_class].keys():
+                try:
+                    iday = int(sday)
+                    a, b, c = [float(x) for x in table[drug_class][sday][:3]]
+                except ValueError:
+                    continue
+                self.classes.setdefault(drug_class, len(self.classes))
+                self.days.setdefault(iday, len(self.days))
+                coeffs[(self.classes[drug_class], self.days[iday])] = (a, b, c)
+
+        # coeffs[class index][day index] = [a, b, c]; missing models are nan
+        nan = float('nan')
+        self.coeffs = [[list(coeffs.get((ci, di), (nan, nan, nan)))
+                        for di in range(len(self.days))]
+                       for ci in range(len(self.classes))]
+        if np is not None:
+            self.coeffs = np.array(self.coeffs, dtype=np.float64).reshape(
+                len(self.classes), len(self.days), 3)
+
+    def has_class(self, drug_class):
+        return self.classes.has_key(drug_class)
+
+    def has_day(self, iday):
+        return self.days.has_key(int(iday))
+
+    def probability(self, drug_classes, ages, mprs, days):
+        """ Returns the probability of non-adherence for each row."""
+        ci = [self.classes[str(drug_class)] for drug_class in drug_classes]
+        di = [self.days[int(iday)] for iday in days]
+        if np is None:
+            p = []
+            for i, j, age, mpr in zip(ci, di, ages, mprs):
+                a, b, c = self.coeffs[i][j]
+                exp_g = math.exp(a + b*mpr + c*age)
+                p.append(exp_g/(1.0 + exp_g))
+            return p
+        coeff = self.coeffs[ci, di]
+        g = coeff[:,0] + coeff[:,1]*np.asarray(mprs, dtype=np.float64) \
+            + coeff[:,2]*np.asarray(ages, dtype=np.float64)
+        exp_g = np.exp(g)
+        return (exp_g/(1.0 + exp_g)).tolist()
+
+
+_models = {}    # filename -> (mtime, LogisticModel)
+_models_lock = threading.Lock()
+
+def get_model(modelfilename):
+    """ Returns the LogisticModel read from the given file. The file is
+    parsed once per process and again only when it is modified."""
+    mtime = os.path.getmtime(modelfilename)
+    entry = _models.get(modelfilename)
+    if entry is None or entry[0] != mtime:
+        with _models_lock:
+            entry = _models.get(modelfilename)
+            if entry is None or entry[0] != mtime:
+                reader = readTable.readTable(modelfilename)
+                print "read from: ", modelfilename
+                entry = (mtime, LogisticModel(reader.read()))
+                _models[modelfilename] = entry
+    return entry[1]
@@ -0,0 +1,181 @@
+
+# Imports
+import time
+import adherence_predict as adhere
+import drug_names
+from django.conf import settings
+
+# Global variables
+MODEL_PREDICTION_DAYS = [60,90,120]
+GAP_THRESHOLD = 30              # default threshold in days
+GOOD_THRESHOLD = 0.9            # mpr of good adherence
+ACCEPTABLE_THRESHOLD = 0.8      # mpr of acceptable adherence
+
+
+"""
+File: adherence_tests.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Registry of the medication adherence tests. Each test is a
+    function of a DrugData, the values of one drug that all the tests share
+    (length of the history, largest gap, mpr, drug class, age on the first
+    fill), which the gap check computes once per drug from its refill
+    history. A new test is added with the adherence_test decorator:
+
+        @adherence_tests.adherence_test('my test')
+        def my_test(drug):
+            return ...
+
+    and its result, with the time it took, is returned for every drug by
+    run_tests without another pass over the fulfillments. The adherence
+    flag shown on the pages is made from the results of the gap, mpr and
+    prediction tests registered here (see adherence_flag).
+
+    Tests must be registered when the module is imported (e.g. in the module
+    that defines them) so that they are also known to the worker processes
+    the gap check may run drugs in.
+
+"""
+class DrugData():
+    """ What the adherence tests know about one drug."""
+
+    def __init__(self, name, nDays, max_gap, mpr_on, drug_class, age, drug_classes):
+        self.name = name
+        self.nDays = nDays              # days from the first fill through the last pill
+        self.max_gap = max_gap          # longest time, in days, without pills
+        self.mpr_on = mpr_on            # mpr_on(day): mpr at the end of a day
+        self.mpr = mpr_on(nDays)        # mpr at the end of the history
+        self.drug_class = drug_class    # None if the class is not known
+        self.age = age                  # age in years on the first fill
+        self.drug_classes = drug_classes
+
+
+class TestResult():
+    """ The result of one test for one drug, and the seconds it took."""
+
+    def __init__(self, value, seconds):
+        self.value = value
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "TestResult(%r, %.6f)" % (self.value, self.seconds)
+
+
+_tests = []     # (name, function), in the order they were registered
+
+def adherence_test(name):
+    """ Decorator registering a test function under the given name. A test
+    registered under the name of another one replaces it."""
+    def decorator(function):
+        register(name, function)
+        return function
+    return decorator
+
+def register(name, function):
+    for i, (test_name, test_function) in enumerate(_tests):
+        if test_name == name:
+            _tests[i] = (name, function)
+            return
+    _tests.append((name, function))
+
+def unregister(name):
+    _tests[:] = [(test_name, function) for test_name, function in _tests if test_name != name]
+
+def test_names():
+    """ The names of the registered tests, in the order they are run."""
+    return [name for name, function in _tests]
+
+def run_tests(drug, names=None):
+    """ Runs the registered tests (or the named ones) on a DrugData and
+    returns {test name: TestResult}."""
+    results = {}
+    for name, function in _tests:
+        if names is not None and name not in names:
+            continue
+        start = time.time()
+        value = function(drug)
+        results[name] = TestResult(value, time.time() - start)
+    return results
+
+def add_timings(timings, results):
+    """ Adds the seconds taken by each test in results to the totals in the
+    timings dict."""
+    for name, result in results.items():
+        timings[name] = timings.get(name, 0.0) + result.seconds
+
+
+@adherence_test('gap')
+def gap_test(drug):
+    """ True if the drug was interrupted for longer than GAP_THRESHOLD
+    days."""
+    return drug.max_gap > GAP_THRESHOLD
+
+@adherence_test('mpr')
+def mpr_test(drug):
+    """ The adherence level of the current mpr: 'good', 'acceptable' or
+    'poor'."""
+    return mpr_level(drug.mpr)
+
+@adherence_test('prediction')
+def prediction_test(drug):
+    """ The 1-year adherence predicted by the logistic regression model for
+    the drugs of a known class filled for less than a year: 0 for good
+    adherence, 1 for poor, -1 if no prediction was made."""
+    if drug.drug_class is None or drug.nDays >= 360:
+        return -1
+    logistic_data_file = settings.MEDIA_ROOT + "genLinearModel.txt"
+    adherence = adhere.adherence_predict(logistic_data_file, drug.drug_classes)
+    return predict_adherence(adherence, drug.name, drug.age, drug.nDays, drug.mpr_on)
+
+
+def mpr_level(mpr):
+    if mpr >= GOOD_THRESHOLD:
+        return 'good'
+    elif mpr >= ACCEPTABLE_THRESHOLD:
+        return 'acceptable'
+    return 'poor'
+
+def find_drug_class(name, all_drug_classes):
+    """ Returns the class of a drug, or None if the class is not known (see
+    drug_names.py)."""
+    return drug_names.drug_class(name, all_drug_classes)
+
+def predict_adherence(adherence, name, age, nDays, mpr_on):
+    """ Returns the logistic regression prediction for the mpr at 60, 90 and
+    120 days (the prediction for the latest of these days covered by the
+    history is used): 0 for good adherence, 1 for poor, -1 if no prediction
+    was made. mpr_on(day) gives the mpr at the end of a day."""
+    prediction_days = [day for day in MODEL_PREDICTION_DAYS if day <= nDays]
+    if not prediction_days:
+        return -1
+    rows = [(name, age, mpr_on(day), day) for day in prediction_days]
+    return adherence.predict_many(rows)[-1]
+
+def adherence_flag(drug, results):
+    """ Returns the adherence flag of a drug from the results of its gap,
+    mpr and prediction tests (a test that was not run counts as passed)."""
+    # flag=0: 30-day gaps; flag=1: predicted 1-year MPR<0.8;
+    # flag=2: Actual 1-year MPR<0.8; flag=3: Predicted 1-year MPR>0.8;
+    # flag=4: Actual 1-year MPR>0.8
+    gap = results.has_key('gap') and results['gap'].value
+    if results.has_key('mpr'):
+        level = results['mpr'].value
+    else:
+        level = mpr_level(drug.mpr)
+    pMPR_yesno = -1
+    if results.has_key('prediction'):
+        pMPR_yesno = results['prediction'].value
+
+    if gap:   # 30-day gaps
+        flag = 0
+    elif drug.nDays >= 360 or pMPR_yesno == -1:     # no prediction
+        flag = {'good': 1, 'acceptable': 2, 'poor': 3}[level]
+    elif pMPR_yesno == 0: # good adherence predicted
+        if level != 'poor': flag = 4
+        else: flag = 5 # good predicted; current mpr is poor
+    else:
+        flag = 6    # poor predicted adherence
+    return flag
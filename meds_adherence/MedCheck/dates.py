@@ -0,0 +1,46 @@
+
+# Imports
+import datetime
+
+# Global variables
+ISO_8601_DATETIME = '%Y-%m-%d'
+MAX_MEMO = 4096     # dates remembered by iso_ordinal
+
+
+"""
+File: dates.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Fast parsing of the ISO 8601 dates (YYYY-MM-DD) of the
+    fulfillments and of the birthday. Dates are converted to proleptic
+    Gregorian ordinals (date.toordinal()), which is all the gap check needs
+    to count days. The fixed-width form is parsed by slicing instead of
+    datetime.strptime, and the ordinals of the dates already seen are
+    remembered, since a patient's fills and the birthday repeat the same
+    dates. Other forms accepted by strptime (e.g. 2008-1-5) still go
+    through strptime, and invalid dates raise ValueError as strptime does.
+
+"""
+_memo = {}
+
+def iso_ordinal(s):
+    """ Returns the ordinal of an ISO 8601 date string."""
+    try:
+        return _memo[s]
+    except KeyError:
+        pass
+    if len(_memo) >= MAX_MEMO:
+        _memo.clear()
+    ordinal = _parse(s)
+    _memo[s] = ordinal
+    return ordinal
+
+def _parse(s):
+    s = str(s)
+    if len(s) == 10 and s[4] == '-' and s[7] == '-' and s[:4].isdigit() \
+            and s[5:7].isdigit() and s[8:].isdigit():
+        return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:])).toordinal()
+    return datetime.datetime.strptime(s, ISO_8601_DATETIME).toordinal()
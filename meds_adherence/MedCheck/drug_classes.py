@@ -0,0 +1,133 @@
+
+# Imports
+import hashlib
+import json
+import os
+import sys
+import threading
+
+# Global variables
+DRUG_CLASS_FILE = "drugClass.xls"
+
+
+"""
+File: drug_classes.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: The drug class table (drug name -> drug class) from
+    Media/drugClass.xls. The table is loaded once per process and only
+    reloaded when the spreadsheet changes. Reading the spreadsheet needs
+    xlrd, so the table is also compiled to a JSON sidecar (drugClass.json)
+    next to the spreadsheet, which is used as long as it was compiled from
+    the current spreadsheet. To recompile the sidecar after editing the
+    spreadsheet, run:
+
+        python drug_classes.py path/to/drugClass.xls
+
+    Drug names are stored in lower case, the way gap_check looks them up.
+
+"""
+def get_drug_classes(xlsfilename=None):
+    """ Returns the {drug name: drug class} table."""
+    if xlsfilename is None:
+        from django.conf import settings
+        xlsfilename = settings.MEDIA_ROOT + DRUG_CLASS_FILE
+    return _table.get(xlsfilename)
+
+def read_xls(xlsfilename):
+    """ Reads the drug class table from the spreadsheet: the first sheet
+    has one drug per row, with the name in the first column and the class
+    in the second."""
+    import xlrd
+    rows = []
+    wb = xlrd.open_workbook(xlsfilename)  # Excel workbook
+    sh = wb.sheet_by_index(0)             # first sheet
+    for rownum in range(sh.nrows):
+        row = sh.row_values(rownum)
+        rows.append((row[0], row[1]))
+    return compile_table(rows)
+
+def compile_table(rows):
+    """ Builds the lookup table from (drug name, drug class) rows. The class
+    strings are shared between the entries of the same class."""
+    classes = {}
+    drugclass = {}
+    for name, cls in rows:
+        drugclass[name.strip().lower()] = classes.setdefault(cls, cls)
+    return drugclass
+
+def write_sidecar(xlsfilename, drugclass):
+    """ Writes the compiled table to the JSON sidecar of the spreadsheet."""
+    f = open(sidecar_name(xlsfilename), 'w')
+    try:
+        json.dump({'source_sha1': _file_sha1(xlsfilename),
+                   'drug_classes': drugclass}, f,
+                  indent=0, separators=(',', ': '), sort_keys=True)
+    finally:
+        f.close()
+
+def sidecar_name(xlsfilename):
+    return os.path.splitext(xlsfilename)[0] + ".json"
+
+
+class _DrugClassTable():
+    """ The loaded tables, by spreadsheet file name."""
+
+    def __init__(self):
+        self.tables = {}    # filename -> (mtime, table)
+        self.lock = threading.Lock()
+
+    def get(self, xlsfilename):
+        mtime = os.path.getmtime(xlsfilename)
+        entry = self.tables.get(xlsfilename)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with self.lock:
+            entry = self.tables.get(xlsfilename)
+            if entry is None or entry[0] != mtime:
+                entry = (mtime, self.load(xlsfilename))
+                self.tables[xlsfilename] = entry
+            return entry[1]
+
+    def load(self, xlsfilename):
+        # Use the sidecar if it was compiled from this spreadsheet
+        try:
+            f = open(sidecar_name(xlsfilename))
+            try:
+                sidecar = json.load(f)
+            finally:
+                f.close()
+            if sidecar['source_sha1'] == _file_sha1(xlsfilename):
+                return compile_table(sidecar['drug_classes'].items())
+        except (IOError, ValueError, KeyError):
+            pass
+
+        drugclass = read_xls(xlsfilename)
+        try:
+            write_sidecar(xlsfilename, drugclass)
+        except IOError:
+            pass
+        return drugclass
+
+_table = _DrugClassTable()
+
+def _file_sha1(filename):
+    f = open(filename, 'rb')
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+
+if __name__ == "__main__":
+
+    if(len(sys.argv) != 2):
+        print "Usage:  python drug_classes.py drugClass.xls"
+        sys.exit()
+    xlsfilename = sys.argv[1]
+    drugclass = read_xls(xlsfilename)
+    write_sidecar(xlsfilename, drugclass)
+    print "Wrote %d drugs to %s" % (len(drugclass), sidecar_name(xlsfilename))
@@ -0,0 +1,74 @@
+
+# Imports
+import ndfrt_index
+
+# Global variables
+MAX_MEMO = 4096     # drug names remembered by drug_class
+
+
+"""
+File: drug_names.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Resolution of drug names to drug classes, for all of
+    MedCheck (the adherence tests, the logistic prediction, the batch job).
+    A class is looked up in the NDF-RT index (see ndfrt_index.py), or else
+    in the drug class table by the short name of the drug (the first word
+    of its name, in lower case). The same names come back for every fill
+    and every prediction day, and for every record in the batch job, so the
+    classes of the names already resolved are remembered, up to MAX_MEMO
+    names. The memo is emptied when the drug class table or the index
+    changes. memo_stats() returns the number of lookups that were answered
+    from the memo (hits) and of the ones that were not (misses).
+
+"""
+_memo = {}          # drug name -> drug class or None
+_sources = None     # (drug class table, index) the memo was filled from
+_hits = 0
+_misses = 0
+
+def short_name(name):
+    """ The first word of a drug name, in lower case: the key of the drug
+    class table."""
+    return name.split()[0].lower()
+
+def drug_class(name, all_drug_classes):
+    """ Returns the class of a drug, or None if the class is not known."""
+    global _sources, _hits, _misses
+    index = ndfrt_index.get_index()
+    sources = _sources
+    if sources is None or sources[1] is not index or (sources[0] is not all_drug_classes
+                                                       and sources[0] != all_drug_classes):
+        # The worker processes of gap_check get a copy of the same table
+        # with each drug, hence the comparison
+        _memo.clear()
+        _sources = (all_drug_classes, index)
+    try:
+        cls = _memo[name]
+        _hits += 1
+        return cls
+    except KeyError:
+        pass
+    _misses += 1
+    if len(_memo) >= MAX_MEMO:
+        _memo.clear()
+    cls = None
+    if index is not None:
+        cls = index.lookup(name)
+    if cls is None:
+        cls = all_drug_classes.get(short_name(name))
+    _memo[name] = cls
+    return cls
+
+def memo_stats():
+    """ Returns {'hits': n, 'misses': n, 'size': names in the memo}. The
+    counts are per process, since the process started or reset_stats()
+    was called (they are not locked, so threads may lose a few)."""
+    return {'hits': _hits, 'misses': _misses, 'size': len(_memo)}
+
+def reset_stats():
+    global _hits, _misses
+    _hits = _misses = 0
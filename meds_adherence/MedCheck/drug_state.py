@@ -0,0 +1,131 @@
+
+# Imports
+import datetime
+import hashlib
+import adherence_tests as tests
+import dates
+import mpr_engine
+import refill_history
+
+
+"""
+File: drug_state.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Incremental version of the gap check. The state of a drug
+    after its last known fill (pill supply and pills taken at that fill,
+    length of the history, largest gap, mpr on the model prediction days)
+    is enough to compute its mpr and adherence flag, and to extend it when
+    new fills arrive after the last one in O(number of new fills).
+
+    The states are kept by the caller (e.g. in the batch job database)
+    between two runs. A state is only extended if the fills it was computed
+    from are unchanged; otherwise (an earlier fill was added, removed or
+    corrected) it is rebuilt from the whole history. Either way the flags
+    are the same as the ones of gap_check. The plotting series are not part
+    of the state: the pages still get them from gap_check.
+
+"""
+class DrugState():
+    """ The adherence state of one drug after its last known fill."""
+
+    def __init__(self, first, npills, age):
+        self.first = first          # date of the first fill
+        self.last = first           # date of the last fill
+        self.offset = 0             # days from the first to the last fill
+        self.q_last = npills        # days supply of the last fill
+        self.span = 0               # days from the first to the last fill, plus the overlaps
+        self.max_gap = 0.0
+        self.event = (0, npills, 0) # (day, pills_available, total_pills_taken) at the last fill
+        self.mpr_days = {}          # mpr on the model prediction days before the last fill
+        self.nfills = 1
+        self.digest = None          # fingerprint of the fills
+        self.age = age              # age in years on the first fill
+
+    def add_fill(self, d, npills):
+        """ Adds a fill made d days after the first one, and after the
+        last one."""
+        if d <= self.offset:
+            raise ValueError("Fill on day %d is not after the last fill" % d)
+        fill_gap = d - self.offset - self.q_last
+        if fill_gap > self.max_gap:
+            self.max_gap = fill_gap
+        self.span += max(d - self.offset, self.q_last)
+
+        # The mpr of the days before this fill does not change any more
+        for day in tests.MODEL_PREDICTION_DAYS:
+            if day < d and not self.mpr_days.has_key(day):
+                self.mpr_days[day] = mpr_engine.event_mpr(self.event, day)
+
+        self.event = mpr_engine.next_event(self.event, d, npills)
+        self.last = self.first + datetime.timedelta(d)
+        self.offset = d
+        self.q_last = npills
+        self.nfills += 1
+
+    def nDays(self):
+        """ Days from the first fill through the day the last pill is taken."""
+        return self.span + self.q_last
+
+    def mpr_on(self, day):
+        """ Returns the mpr at the end of a day."""
+        if self.mpr_days.has_key(day):
+            return self.mpr_days[day]
+        return mpr_engine.event_mpr(self.event, day)
+
+
+def incremental_check(patient_refill_data, drug, birthday, all_drug_classes, states):
+    """ Returns the gap_flag list of gap_check for the given fulfillments,
+    and the new {drug name: DrugState}. states are the states of the
+    previous run (they may be updated in place). The birthday is only used
+    for the drugs whose state has to be rebuilt, and may be None if there
+    are none."""
+    gap_flag = []
+    new_states = {}
+    for history in refill_history.refill_histories(patient_refill_data, drug):
+        name = history.name
+        state = update_state(states.get(name), history, birthday)
+        new_states[name] = state
+
+        # The same adherence tests as gap_check, on the values of the state
+        drug_class = tests.find_drug_class(name, all_drug_classes)
+        data = tests.DrugData(name, state.nDays(), state.max_gap, state.mpr_on,
+                              drug_class, state.age, all_drug_classes)
+        results = tests.run_tests(data)
+        flag = tests.adherence_flag(data, results)
+        if drug_class is None:
+            drug_class = "other"
+        gap_flag.append(refill_history.DrugSummary(name, flag, state.first, state.last, drug_class,
+                                                   data.nDays, data.mpr, results))
+    return gap_flag, new_states
+
+def update_state(state, history, birthday):
+    """ Returns the state of a drug for its RefillHistory. The given state
+    is extended if it was computed from the first fills of the history, and
+    rebuilt otherwise."""
+    offsets = history.offsets
+    npills = history.supply
+    if state is not None and state.nfills <= len(history) and state.first == history.first:
+        n = state.nfills
+        h = _fingerprint(hashlib.sha1(), offsets[:n], npills[:n])
+        if h.hexdigest() == state.digest:
+            for d, q in zip(offsets[n:], npills[n:]):
+                state.add_fill(d, q)
+            state.digest = _fingerprint(h, offsets[n:], npills[n:]).hexdigest()
+            return state
+
+    # Determine the patient's age on the date of first fill for this med
+    age = (history.first.toordinal() - dates.iso_ordinal(birthday))/365
+    state = DrugState(history.first, npills[0], age)
+    for d, q in zip(offsets[1:], npills[1:]):
+        state.add_fill(d, q)
+    state.digest = _fingerprint(hashlib.sha1(), offsets, npills).hexdigest()
+    return state
+
+def _fingerprint(h, offsets, npills):
+    for d, q in zip(offsets, npills):
+        h.update("%d:%d\n" % (d, q))
+    return h
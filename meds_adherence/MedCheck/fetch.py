@@ -0,0 +1,59 @@
+
+# Imports
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+"""
+File: fetch.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Issues independent calls to the SMArt container at the same
+    time, so that a page waits for the slowest call instead of the sum of
+    all of them. The time taken by each call is logged (logger
+    'MedCheck.fetch') and can be returned to the caller.
+
+"""
+def fetch_concurrently(calls, timings=None):
+    """ Runs each (name, function) pair of calls in its own thread and
+    returns the results of the functions, in the same order, once they have
+    all completed. If timings is a dict, the number of seconds taken by each
+    call is stored in it by name. If a call raises an exception, the first
+    such exception is raised again here."""
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    seconds = [0.0] * len(calls)
+
+    def run(i, function):
+        start = time.time()
+        try:
+            results[i] = function()
+        except Exception:
+            errors[i] = sys.exc_info()
+        seconds[i] = time.time() - start
+
+    threads = [threading.Thread(target=run, args=(i, function))
+               for i, (name, function) in enumerate(calls)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for (name, function), s in zip(calls, seconds):
+        logger.info("%s: %.3f s", name, s)
+        if timings is not None:
+            timings[name] = s
+    logger.info("all fetches: %.3f s", time.time() - start)
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
@@ -1,9 +1,15 @@
 
 # Imports
-import datetime
-import adherence_predict as adhere
+import adherence_tests as tests
+import dates
+import mpr_engine
+import refill_history
 from django.conf import settings
 import math
+import multiprocessing
+import os
+import threading
+import time
 
 # Global variables
 ISO_8601_DATETIME = '%Y-%m-%d'
@@ -18,182 +24,146 @@ File: gap_check.py
     Boston, MA 02115
 
     Description: This class has a function that takes a list of prescription fulfillment
-    dates and checks for gaps larger than a specified threshold. It also calls
-    the adherence prediction function. Return values include the mpr time
+    dates and runs the adherence tests of adherence_tests.py (the gap check,
+    the mpr threshold, the adherence prediction) on the refill history of
+    each drug. If settings.GAP_CHECK_WORKERS is set, the drugs of patients
+    with many long histories are checked in a pool of worker processes (see
+    parallel_pays_off), and the results are merged back in the order of the
+    drug names. Return values include the mpr time
     series, gap check results, 1-year adherence prediction, dates of refills
-    and gaps: all the variables needed for plotting.
+    and gaps: all the variables needed for plotting. With series='breakpoints'
+    only the breakpoints of the mpr curve are returned, which keeps
+    the data sent to risk.html small (see mpr_engine.py).
 
 """
-def gap_check(patient_refill_data, drug, birthday, all_drug_classes):
+def gap_check(patient_refill_data, drug, birthday, all_drug_classes, series=None,
+              timings=None, pool=None):
+    """ Runs the adherence tests (see adherence_tests.py) on each drug of the
+    fulfillment rows. If timings is a dict, the seconds taken by each test,
+    and by the mpr series the tests share ('series'), are added to it by
+    name. The drugs are checked in the given multiprocessing pool, or, if
+    none is given, in the pool of gap_check when parallel_pays_off (pool
+    False: always in this process)."""
     
     # Local variables
-    model_prediction_days = [60,90,120]
-    threshold = 30     # default threshold in days
     gap_flag = []
-    max_gap = {}
-    refill_data = {}
     mpr_tseries = {}
     refill_day = {}
     gaps = {}
     actualMPR = {}
-    logistic_data_file = settings.MEDIA_ROOT + "genLinearModel.txt"
-    adherence = adhere.adherence_predict(logistic_data_file, all_drug_classes)
+    if series is None:
+        series = getattr(settings, 'MPR_SERIES', 'dense')
+    step = getattr(settings, 'MPR_SERIES_STEP', 0)
         
-    # Go through the list of refill data for each drug and determine which have gaps
-    for data in patient_refill_data: 
-        #med = data[0]
-        name = data[1]
-        if drug=='all' or drug==name:
-            quant = int(data[2])
-            when = data[3]
-            d = datetime.datetime.strptime(str(when), ISO_8601_DATETIME) 
-            actualMPR[name] = [0.7,0.8,0.9,1.0] 
-            age_on_first_fill = {}
-                    
-            # Organize all refill dates by drug name 
-            max_gap[name] = 0.0
-            if not refill_data.has_key(name):
-                refill_data[name] = {}
-                mpr_tseries[name] = []
-                gaps[name] = []
-                refill_day[name] = []
-            refill_data[name][d] = quant
-                    
-    # Check for gaps and predict adherence
-    for name in sorted(refill_data.keys()):
-        dates = refill_data[name].keys()
-        npills = refill_data[name].values()
-        pMPR_yesno = -1 # default value: no prediction made
-        
-        
-        # Sort dates and npills list together / simultaneously
-        dates, npills = zip(*sorted(zip(dates, npills)))
-        nDates = len(dates)
-        date0 = dates[0]
-        first = date0       # This will change; it's the fill date or the day on which the 
-        last = date0        # next batch of pills will start to be used.
-        
-        # Determine the total length of time, in days, pills have been taken, 
-        # including gaps (that is, from first day through the day when the 
-        # last pill from the last prescription fill was taken.
-        nDays = 0
-        for i in range(1,nDates):
-            s1 = (dates[i] - dates[i-1]).days
-            s2 = npills[i-1]
-            if s1>s2: nDays = nDays + s1
-            else: nDays = nDays + s2
-        nDays = nDays + npills[nDates-1]
-        
-        print "Drug: ", name, "; nDays = ", nDays,"; nDates = ", nDates,", lenpills = ", len(npills)
+    # Organize all refill dates by drug name, then check each drug for gaps
+    # and predict adherence
+    histories = refill_history.refill_histories(patient_refill_data, drug)
+    if histories:
+        birthday_ordinal = dates.iso_ordinal(birthday)
+    args = [(history, birthday_ordinal, all_drug_classes, series, step) for history in histories]
+    if pool is None and parallel_pays_off(histories, series):
+        pool = worker_pool()
+    if pool:
+        # map keeps the order of the drug names
+        checks = pool.map(_check_drug, args)
+    else:
+        checks = map(_check_drug, args)
 
-        make_prediction = False
-        shortname = name.split()[0].lower()   
-        if shortname in all_drug_classes.keys():
-            drug_class = all_drug_classes[shortname]
-            # If the total pills for all refills is less than 1 year, make an adherence
-            # prediction based on the regression model.
-            
-            if nDays < 360: 
-                make_prediction = True
-        else:
-            drug_class = "other"
-            
-        
-        # Determine the patient's age on the date of first fill for this med
-        bd = datetime.datetime.strptime(str(birthday), ISO_8601_DATETIME)
-        age_on_first_fill[name] = date0 - bd      
-        age = age_on_first_fill[name].days/365          # Age in years on first fill date
-                
-        mpr = 1.0
-        day = 0     # Initial fill
-        pills_available = npills[0]
-        total_pills_taken = 0
-        days_since_initial_fill = 0
-        next_refill_index = 1
-        next_refill_day = 0
-        if nDates > 1:
-            next_refill_day = (dates[1] - date0).days
-        mpr_tseries[name].append( [0, mpr] )
-        refill_day[name].append([0,1.0])
-        for day in range(1, nDays+1): 
-                                        
-            # Is it time for a refill? Check to see if prescription was filled
-            if day == next_refill_day and next_refill_day < nDays:
-                refill_day[name].append([day,mpr])
-                pills_available += npills[next_refill_index]
-                next_refill_index += 1
-                if nDates > next_refill_index:                    
-                    next_refill_day = (dates[next_refill_index] - date0).days       
-            
-            # Does the patient still have pills left? If so, increment
-            if pills_available > 0:
-                pills_available -= 1
-                total_pills_taken += 1
-            # Time marches on whether or not patient has pills
-            days_since_initial_fill += 1
-                
-            # Compute the current mpr
-            mpr = 1.0*total_pills_taken / days_since_initial_fill
-            
-            # If this is the last refill, check to see if we need 
-            # to make an adherence prediction
-            if (day in model_prediction_days) and make_prediction:
-                # Record the mpr at 60, 90 and 120 days, in case we need to make a prediction  
-                pMPR_yesno = adherence.predict(name, age, mpr, day) 
-                                            
-            # If the number of available pills is less than zero, we have a gap
-            if pills_available == 0 and day < nDays:
-                mpr_tseries[name].append( "null" )
-                gaps[name].append( [day, mpr] )
-            else:
-                mpr_tseries[name].append( [day, mpr] )
-                                       
-        for i in range(1,len(dates)):
-            #q = refill_data[name][dates[i-1]]
-            
-            # Get the number of pills at the last refill
-            q = npills[i-1]                        
-            last = dates[i]                       
- 
-            gap = (dates[i] - dates[i-1]).days - q
-            if gap > max_gap[name]:
-                max_gap[name] = gap
-                
-        # flag=0: 30-day gaps; flag=1: predicted 1-year MPR<0.8;
-        # flag=2: Actual 1-year MPR<0.8; flag=3: Predicted 1-year MPR>0.8;
-        # flag=4: Actual 1-year MPR>0.8 
-        good_threshold = 0.9
-        acceptable_threshold = 0.8
-        
-        if max_gap[name] > threshold:   # 30-day gaps
-            flag = 0
-            
-        elif nDays >= 360:
-            if mpr >= good_threshold:
-                flag = 1
-            elif mpr >= acceptable_threshold:
-                flag = 2
-            else:
-                flag = 3
-                
-        elif nDays < 360:
-            if pMPR_yesno == -1:     # no prediction
-                if mpr >= good_threshold:
-                    flag = 1
-                elif mpr >= acceptable_threshold:
-                    flag = 2
-                else:
-                    flag = 3
-            else:
-                if pMPR_yesno == 0: # good adherence predicted
-                    if mpr >= acceptable_threshold: flag = 4
-                    else: flag = 5 # good predicted; current mpr is poor
-                else:  
-                    flag = 6    # poor predicted adherence
-        
-        urlname = name.replace (" ", "%20")
-        gap_flag.append([name, urlname, flag, first, last, drug_class, nDays, mpr])        
+    for summary, gaps_days, tseries, refills, seconds in checks:
+        name = summary.name
+        actualMPR[name] = [0.7,0.8,0.9,1.0] 
+        gaps[name] = gaps_days
+        mpr_tseries[name] = tseries
+        refill_day[name] = refills
+        gap_flag.append(summary)
+        if timings is not None:
+            timings['series'] = timings.get('series', 0.0) + seconds
+            tests.add_timings(timings, summary.tests)
                 
     return gap_flag, gaps, mpr_tseries, refill_day, actualMPR
 
-    
\ No newline at end of file
+def parallel_pays_off(histories, series):
+    """ True if the drugs of these histories are worth checking in the
+    worker processes: the work of the mpr series grows with the number of
+    days of each history, and has to make up for sending the histories to
+    the workers and the series back. The dense series (one point a day)
+    take longer to send back than to compute, so they are never worth it."""
+    if series == 'dense':
+        return False
+    workers = getattr(settings, 'GAP_CHECK_WORKERS', 0)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 2:
+        return False
+    if len(histories) < 2 or multiprocessing.current_process().daemon:
+        return False    # a pool worker cannot have its own workers
+    total_days = 0
+    for history in histories:
+        total_days += history.nDays()
+    return total_days >= getattr(settings, 'GAP_CHECK_PARALLEL_DAYS', 200000)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def worker_pool():
+    """ The pool of worker processes of gap_check, GAP_CHECK_WORKERS of
+    them (None for the number of CPUs). It is started on first use, and
+    again in a process forked after that."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(getattr(settings, 'GAP_CHECK_WORKERS', None))
+            _pool_pid = os.getpid()
+    return _pool
+
+def _check_drug(args):
+    return check_drug(*args)
+
+def check_drug(history, birthday_ordinal, all_drug_classes, series, step):
+    """ Computes the mpr series of one drug and runs the adherence tests on
+    it. Returns (DrugSummary, gaps, mpr_tseries, refill_day, seconds taken
+    by the series)."""
+    name = history.name
+    
+    # Day offsets from the first fill and days supply of each fill
+    offsets = history.offsets
+    npills = history.supply
+    nDates = len(history)
+    first = history.first   # date of the first fill
+    last = history.last()   # date of the last fill
+    
+    # Determine the total length of time, in days, pills have been taken, 
+    # including gaps (that is, from first day through the day when the 
+    # last pill from the last prescription fill was taken.
+    nDays = history.nDays()
+    
+    print "Drug: ", name, "; nDays = ", nDays,"; nDates = ", nDates,", lenpills = ", len(npills)
+
+    drug_class = tests.find_drug_class(name, all_drug_classes)
+    
+    # Determine the patient's age on the date of first fill for this med
+    age_on_first_fill = first.toordinal() - birthday_ordinal
+    age = age_on_first_fill/365          # Age in years on first fill date
+            
+    # Pill supply and MPR from the first fill to the last pill: either
+    # for every day, or only at the breakpoints of the curves
+    start = time.time()
+    if series == 'dense':
+        mpr_days, gaps, refill_day = mpr_engine.mpr_series(offsets, npills, nDays)
+        mpr_tseries = mpr_engine.mpr_tseries(mpr_days, gaps)
+        mpr_on = mpr_days.__getitem__
+    else:
+        events = mpr_engine.mpr_events(offsets, npills, nDays)
+        mpr_tseries, gaps, refill_day = mpr_engine.mpr_breakpoints(events, nDays, step)
+        mpr_on = lambda day: mpr_engine.mpr_at(events, day)
+    seconds = time.time() - start
+
+    # The tests share the values computed above
+    data = tests.DrugData(name, nDays, history.max_gap(), mpr_on, drug_class, age, all_drug_classes)
+    results = tests.run_tests(data)
+    flag = tests.adherence_flag(data, results)
+    if drug_class is None:
+        drug_class = "other"
+    summary = refill_history.DrugSummary(name, flag, first, last, drug_class, nDays, data.mpr, results)
+    return summary, gaps, mpr_tseries, refill_day, seconds
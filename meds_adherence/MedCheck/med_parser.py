@@ -0,0 +1,127 @@
+
+# Imports
+from cStringIO import StringIO
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+# Global variables
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+SP = '{http://smartplatforms.org/terms#}'
+DCTERMS = '{http://purl.org/dc/terms/}'
+
+
+"""
+File: med_parser.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Fast extraction of the medication fulfillments from the
+    RDF/XML medication list of a SMArt record. The document is streamed
+    once with iterparse and the (med, name, quant, when) rows of
+    adherence_check.FULFILLMENT_QUERY are read directly from the nested
+    elements the SMArt container writes:
+
+        <sp:Medication rdf:about="...">
+          <sp:drugName><sp:CodedValue>
+            <dcterms:title>...</dcterms:title>
+          </sp:CodedValue></sp:drugName>
+          <sp:fulfillment><sp:Fulfillment>
+            <dcterms:date>...</dcterms:date>
+            <sp:dispenseDaysSupply>...</sp:dispenseDaysSupply>
+          </sp:Fulfillment></sp:fulfillment>
+        </sp:Medication>
+
+    Any other way of writing the same graph (rdf:Description nodes, node
+    references, parseType...) is reported as an unknown shape, and the
+    caller falls back to parsing the RDF graph and running the SPARQL query.
+
+"""
+class UnknownShape(Exception):
+    pass
+
+def parse_fulfillments(rdfxml):
+    """ Returns the list of (med, name, quant, when) fulfillment rows of the
+    medication list, or None if the document is not in the expected shape."""
+    try:
+        return list(iter_fulfillments(rdfxml))
+    except UnknownShape:
+        return None
+
+def iter_fulfillments(rdfxml):
+    """ Yields the (med, name, quant, when) fulfillment rows of the
+    medication list. Raises UnknownShape if the document is not in the
+    expected shape."""
+    depth = 0
+    top = None      # tag of the top level node being read
+    seen = set()    # the nodes already read, which may not be described twice
+    for event, elem in ElementTree.iterparse(StringIO(rdfxml), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                top = elem.tag
+            if elem.tag == RDF + 'Description' or elem.get(RDF + 'parseType') is not None:
+                raise UnknownShape(elem.tag)
+            if elem.tag == SP + 'Medication' and depth != 2:
+                raise UnknownShape(elem.tag)
+            if elem.tag == RDF + 'type' and top != SP + 'Medication' and \
+                    elem.get(RDF + 'resource') == SP[1:-1] + 'Medication':
+                raise UnknownShape(elem.tag)
+            continue
+        depth -= 1
+
+        # Top level nodes (children of rdf:RDF)
+        if depth == 1:
+            if elem.tag == SP + 'Medication':
+                for row in _medication_rows(elem, seen):
+                    yield row
+            elif elem.tag in (SP + 'Fulfillment', SP + 'CodedValue'):
+                raise UnknownShape(elem.tag)
+            elem.clear()
+
+def _medication_rows(med, seen):
+    uri = med.get(RDF + 'about') or med.get(RDF + 'nodeID')
+    _check_new(uri, seen)
+    names = []
+    fills = []
+    for prop in med:
+        if prop.tag == SP + 'drugName':
+            names.extend(_nested(prop, SP + 'CodedValue').findall(DCTERMS + 'title'))
+        elif prop.tag == SP + 'fulfillment':
+            fill = _nested(prop, SP + 'Fulfillment')
+            _check_new(fill.get(RDF + 'about') or fill.get(RDF + 'nodeID'), seen)
+            fills.append(fill)
+    if len(names) > 1:
+        raise UnknownShape('several drug names')
+    if not names:
+        return
+
+    name = _text(names[0])
+    for fill in fills:
+        quant = fill.findall(SP + 'dispenseDaysSupply')
+        when = fill.findall(DCTERMS + 'date')
+        if len(quant) > 1 or len(when) > 1:
+            raise UnknownShape('several fulfillment values')
+        if quant and when:
+            yield (unicode(uri or ''), name, _text(quant[0]), _text(when[0]))
+
+def _text(elem):
+    return unicode(elem.text or '')
+
+def _check_new(node, seen):
+    # A node described twice is merged in the RDF graph
+    if node is not None:
+        if node in seen:
+            raise UnknownShape(node)
+        seen.add(node)
+
+def _nested(prop, tag):
+    # The node a property points to, written as its only child element
+    if prop.get(RDF + 'resource') is not None or prop.get(RDF + 'nodeID') is not None:
+        raise UnknownShape(prop.tag)
+    if len(prop) != 1 or prop[0].tag != tag:
+        raise UnknownShape(prop.tag)
+    return prop[0]
@@ -0,0 +1,207 @@
+
+# Imports
+import bisect
+import sys
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""
+File: mpr_engine.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Computes the day-by-day pill supply and medication possession
+    ratio (MPR) of a single drug from its refill events. The refill events are
+    given as day offsets from the first fill (offsets[0] == 0) together with the
+    days supply dispensed at each fill.
+
+    The patient takes one pill a day while pills are available, so the supply
+    on hand is a random walk that is clipped at zero. With NumPy the whole
+    history is computed in one array pass: the cumulative supply minus the
+    elapsed days, reflected at zero with a running minimum. Without NumPy the
+    day-by-day loop is used instead; both give identical results.
+
+    Between two refills the state of the patient only changes in a regular
+    way (one pill a day until the supply runs out), so the same curve can
+    also be described by its breakpoints: the refill days, the days the
+    supply is exhausted and the ends of the gaps. mpr_events computes the
+    state at each refill in O(number of refills) and mpr_breakpoints turns
+    it into a compact plotting series. next_event extends the state by one
+    refill, which is what drug_state.py uses to update a drug's state when
+    new fills arrive.
+
+"""
+def mpr_series(offsets, npills, nDays):
+    """ Returns mpr, gaps, refill_day for days 0..nDays.
+
+    mpr[day] is the MPR at the end of that day, gaps is the list of
+    [day, mpr] pairs on which the patient ran out of pills and refill_day
+    the list of [day, mpr] pairs marking the fills (with the MPR of the
+    previous day, as plotted in risk.html)."""
+    if np is None:
+        return _mpr_series_loop(offsets, npills, nDays)
+    return _mpr_series_numpy(offsets, npills, nDays)
+
+def mpr_tseries(mpr, gaps):
+    """ Builds the plotting series: [day, mpr] pairs, with "null" on gap days
+    so that the line is broken where the patient had no pills."""
+    tseries = [[day, m] for day, m in enumerate(mpr)]
+    for day, m in gaps:
+        tseries[day] = "null"
+    return tseries
+
+def mpr_events(offsets, npills, nDays):
+    """ Returns the (day, pills_available, total_pills_taken) state at the
+    end of the first fill day and of every refill day."""
+    events = [(0, npills[0], 0)]
+    for d, q in zip(offsets[1:], npills[1:]):
+        if d >= nDays:
+            break
+        events.append(next_event(events[-1], d, q))
+    return events
+
+def next_event(event, d, q):
+    """ Returns the state at the end of refill day d, where q pills are
+    dispensed, from the state at the previous refill."""
+
+    # Pills taken since the last refill, then the refill itself and
+    # the pill taken on the day of the refill
+    pills_available, total_pills_taken = _state_at(event, d-1)
+    pills_available += q
+    if pills_available > 0:
+        pills_available -= 1
+        total_pills_taken += 1
+    return (d, pills_available, total_pills_taken)
+
+def mpr_at(events, day):
+    """ Returns the MPR at the end of the given day."""
+    i = bisect.bisect_right(events, (day, sys.maxint, sys.maxint)) - 1
+    return event_mpr(events[i], day)
+
+def event_mpr(event, day):
+    """ Returns the MPR at the end of the given day, from the state at the
+    last refill on or before that day."""
+    if day == 0:
+        return 1.0
+    pills_available, total_pills_taken = _state_at(event, day)
+    return 1.0*total_pills_taken / day
+
+def mpr_breakpoints(events, nDays, step=0):
+    """ Returns mpr_tseries, gaps, refill_day for the given events.
+
+    Only the breakpoints of the mpr curve are included: the refill days,
+    the last day of each supply and the days around each gap. If step is
+    given, a point is also added every step days so that the curve looks
+    smooth when plotted. The gaps are listed day by day, as mpr_series
+    does, since risk.html draws them as one bar per day."""
+    tseries = []
+    gaps = []
+    refill_day = [[0, 1.0]]
+    for i, event in enumerate(events):
+        r, pills_available, total_pills_taken = event
+        if i+1 < len(events):
+            n = events[i+1][0]
+        else:
+            n = nDays+1
+        if r > 0:
+            refill_day.append([r, event_mpr(events[i-1], r-1)])
+
+        # Days r..start-1 have pills left, days start..end are a gap
+        # (the last day of the history never counts as a gap)
+        start = r + pills_available
+        if r == 0:
+            start = max(start, 1)
+        end = min(n-1, nDays-1)
+        for day in _sample_days(r, min(start-1, n-1), step):
+            tseries.append([day, event_mpr(event, day)])
+        if start <= end:
+            if tseries[-1] != "null":
+                tseries.append("null")
+            for day in range(start, end+1):
+                gaps.append([day, event_mpr(event, day)])
+        if n > nDays and start <= nDays:
+            tseries.append([nDays, event_mpr(event, nDays)])
+
+    return tseries, gaps, refill_day
+
+def _state_at(event, day):
+    r, pills_available, total_pills_taken = event
+    taken = min(day - r, pills_available)
+    return pills_available - taken, total_pills_taken + taken
+
+def _sample_days(first, last, step):
+    if last < first:
+        return []
+    if first == last:
+        return [first]
+    if step > 0:
+        return [first] + range(first+step, last, step) + [last]
+    return [first, last]
+
+def _mpr_series_numpy(offsets, npills, nDays):
+
+    # Pills added on each day. A refill is only counted if it happens
+    # before the last day of the history.
+    supply = np.zeros(nDays+1, dtype=np.int64)
+    refills = [(d, q) for d, q in zip(offsets[1:], npills[1:]) if d < nDays]
+    supply[0] = npills[0]
+    for d, q in refills:
+        supply[d] += q
+
+    # walk[day] = pills dispensed minus days elapsed. The pills on hand are
+    # the walk reflected at zero, and everything else that was dispensed
+    # has been taken.
+    dispensed = np.cumsum(supply)
+    walk = dispensed - np.arange(nDays+1)
+    floor = np.minimum(np.minimum.accumulate(walk), 0)
+    pills_available = walk - floor
+    total_pills_taken = dispensed - pills_available
+
+    days = np.arange(nDays+1)
+    days[0] = 1
+    mpr = total_pills_taken / days.astype(np.float64)
+    mpr[0] = 1.0
+    mpr = mpr.tolist()
+
+    gap_days = np.flatnonzero(pills_available[1:nDays] == 0) + 1
+    gaps = [[day, mpr[day]] for day in gap_days.tolist()]
+    refill_day = [[0, 1.0]] + [[d, mpr[d-1]] for d, q in refills]
+    return mpr, gaps, refill_day
+
+def _mpr_series_loop(offsets, npills, nDays):
+
+    mpr = [1.0]
+    gaps = []
+    refill_day = [[0, 1.0]]
+    pills_available = npills[0]
+    total_pills_taken = 0
+    next_refill_index = 1
+    next_refill_day = 0
+    if len(offsets) > 1:
+        next_refill_day = offsets[1]
+    for day in range(1, nDays+1):
+
+        # Is it time for a refill? Check to see if prescription was filled
+        if day == next_refill_day and next_refill_day < nDays:
+            refill_day.append([day, mpr[-1]])
+            pills_available += npills[next_refill_index]
+            next_refill_index += 1
+            if len(offsets) > next_refill_index:
+                next_refill_day = offsets[next_refill_index]
+
+        # Does the patient still have pills left? If so, increment
+        if pills_available > 0:
+            pills_available -= 1
+            total_pills_taken += 1
+        mpr.append(1.0*total_pills_taken / day)
+
+        # If the number of available pills is zero, we have a gap
+        if pills_available == 0 and day < nDays:
+            gaps.append([day, mpr[-1]])
+
+    return mpr, gaps, refill_day
@@ -0,0 +1,217 @@
+
+# Imports
+import codecs
+import mmap
+import os
+import re
+import sys
+import threading
+import time
+
+# Global variables
+CHECK_EVERY = 2     # seconds between two checks of the index file
+
+
+"""
+File: ndfrt_index.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Local drug class index derived from NDF-RT / RxNorm, so that
+    the drug classes are resolved offline instead of through the RxNav web
+    service (settings.NDF_RT). The index is compiled from a dump with one
+    drug per line,
+
+        drug name <TAB> drug class
+
+    (blank lines and lines starting with # are ignored), where the classes
+    are the MedCheck drug classes of the logistic model (antihypertensives,
+    oral_hypoglycemics, ...) or any other class to show on the pages. To
+    compile a dump to settings.NDF_RT_INDEX, run:
+
+        python ndfrt_index.py dump.txt path/to/Media/ndfrt_index.txt
+
+    The compiled index is a text file with one "normalized name <TAB> class"
+    line per drug, sorted by name. It is memory-mapped (and so shared by all
+    the processes reading it) and searched by bisection, without loading it.
+    A drug name from a medication list (e.g. "Rauwolfia serpentina 50 MG
+    Oral Tablet") is looked up by its longest leading words that are in the
+    index. The drugs that are not in the index fall back to the drug class
+    table of drug_classes.py (see drug_names.py).
+
+"""
+def normalize(name):
+    """ The form of a drug name used as index key: lower case, with the
+    punctuation other than - and / replaced by spaces, the spaces collapsed
+    and the spaces around - and / removed (so that "metformin / sitagliptin"
+    and "Metformin/Sitagliptin" have the same key)."""
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    name = u' '.join(_PUNCTUATION.sub(u' ', name.lower()).split())
+    return _JOINERS.sub(ur'\1', name)
+
+_PUNCTUATION = re.compile(r'[^\w/-]+', re.UNICODE)
+_JOINERS = re.compile(r' ?([/-]) ?', re.UNICODE)
+
+def read_dump(dumpfilename):
+    """ Reads the (drug name, drug class) rows of a dump."""
+    rows = []
+    f = codecs.open(dumpfilename, 'r', 'utf-8')
+    try:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) < 2:
+                raise ValueError("%s: no drug class in line %r" % (dumpfilename, line))
+            rows.append((fields[0], fields[1].strip()))
+    finally:
+        f.close()
+    return rows
+
+def compile_index(rows, indexfilename):
+    """ Writes the index of (drug name, drug class) rows. If a name is given
+    more than once, the last class is used."""
+    classes = {}
+    for name, cls in rows:
+        key = normalize(name)
+        if key:
+            classes[key.encode('utf-8')] = cls.encode('utf-8')
+    tmpname = indexfilename + ".tmp"
+    f = open(tmpname, 'wb')
+    try:
+        for key in sorted(classes.keys()):
+            f.write("%s\t%s\n" % (key, classes[key]))
+    finally:
+        f.close()
+    os.rename(tmpname, indexfilename)
+    return len(classes)
+
+
+class NdfrtIndex():
+    """ A compiled index file, memory-mapped."""
+
+    def __init__(self, indexfilename):
+        self.filename = indexfilename
+        f = open(indexfilename, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''      # an empty file cannot be mapped
+        finally:
+            f.close()
+
+    def get(self, key):
+        """ Returns the class of a normalized name, or None."""
+        key = key.encode('utf-8')
+        data = self.data
+        start = self._lower_bound(key)
+        end = data.find('\n', start)
+        if end < 0:
+            return None
+        name, cls = data[start:end].split('\t')
+        if name == key:
+            return cls.decode('utf-8')
+        return None
+
+    def prefix(self, prefix):
+        """ Yields the (normalized name, class) entries whose names start
+        with the given normalized prefix, in order."""
+        prefix = prefix.encode('utf-8')
+        data = self.data
+        start = self._lower_bound(prefix)
+        while True:
+            end = data.find('\n', start)
+            if end < 0:
+                return
+            name, cls = data[start:end].split('\t')
+            if not name.startswith(prefix):
+                return
+            yield name.decode('utf-8'), cls.decode('utf-8')
+            start = end + 1
+
+    def lookup(self, name):
+        """ Returns the class of a drug name, found by its longest leading
+        words in the index, or None."""
+        words = normalize(name).split(u' ')
+        for n in range(len(words), 0, -1):
+            cls = self.get(u' '.join(words[:n]))
+            if cls is not None:
+                return cls
+        return None
+
+    def _lower_bound(self, key):
+        # Offset of the first line whose name is not less than key. lo and
+        # hi are always offsets of line starts.
+        data = self.data
+        lo = 0
+        hi = len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind('\n', lo, mid) + 1
+            if start == 0:
+                start = lo
+            end = data.find('\n', start)
+            if data[start:data.find('\t', start, end)] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+
+def get_index(indexfilename=None):
+    """ Returns the NdfrtIndex of settings.NDF_RT_INDEX (or of the given
+    file), or None if there is no index. The file is mapped once per process
+    and again when it changes."""
+    if indexfilename is None:
+        from django.conf import settings
+        indexfilename = getattr(settings, 'NDF_RT_INDEX', None)
+        if indexfilename is None:
+            return None
+    return _indexes.get(indexfilename)
+
+
+class _Indexes():
+    """ The mapped indexes, by file name. Whether a file changed is checked
+    at most every CHECK_EVERY seconds, since drug names are resolved far
+    more often than that."""
+
+    def __init__(self):
+        self.indexes = {}   # filename -> (mtime, checked at, NdfrtIndex or None)
+        self.lock = threading.Lock()
+
+    def get(self, indexfilename):
+        now = time.time()
+        entry = self.indexes.get(indexfilename)
+        if entry is not None and now - entry[1] < CHECK_EVERY:
+            return entry[2]
+        try:
+            mtime = os.path.getmtime(indexfilename)
+        except OSError:
+            mtime = None    # no index
+        with self.lock:
+            entry = self.indexes.get(indexfilename)
+            if entry is None or entry[0] != mtime:
+                index = None
+                if mtime is not None:
+                    index = NdfrtIndex(indexfilename)
+                entry = (mtime, now, index)
+            else:
+                entry = (mtime, now, entry[2])
+            self.indexes[indexfilename] = entry
+            return entry[2]
+
+_indexes = _Indexes()
+
+
+if __name__ == "__main__":
+
+    if(len(sys.argv) != 3):
+        print "Usage:  python ndfrt_index.py dump.txt ndfrt_index.txt"
+        sys.exit()
+    n = compile_index(read_dump(sys.argv[1]), sys.argv[2])
+    print "Wrote %d drugs to %s" % (n, sys.argv[2])
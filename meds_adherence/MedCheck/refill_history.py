@@ -0,0 +1,138 @@
+
+# Imports
+import datetime
+import dates
+from array import array
+
+
+"""
+File: refill_history.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Description: Compact representation of the refill histories of a
+    patient. The fulfillment rows (med, name, quant, when) are grouped by
+    drug once, and the fills of each drug are kept sorted by date in two
+    columns: the day offsets from the first fill (array of int32) and the
+    days supply of each fill (array of int16). The gap check, the mpr and
+    the prediction all read these columns instead of building dicts of
+    datetimes for every drug.
+
+    DrugSummary is the result row of the gap check for one drug. It can be
+    used like the list it replaces,
+        [name, urlname, flag, first, last, drug_class, nDays, mpr]
+    (unpacked in the templates and the batch job, indexed in the views).
+
+"""
+class RefillHistory(object):
+    """ The fills of one drug, sorted by date (one fill per date)."""
+    __slots__ = ('name', 'first', 'offsets', 'supply')
+
+    def __init__(self, name, first, offsets, supply):
+        self.name = name
+        self.first = first              # datetime of the first fill
+        self.offsets = offsets          # array('i'): days from the first fill
+        self.supply = supply            # array('h'): days supply of each fill
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def last(self):
+        """ The datetime of the last fill."""
+        return self.first + datetime.timedelta(self.offsets[-1])
+
+    def nDays(self):
+        """ The total length of time, in days, pills have been taken,
+        including gaps (that is, from first day through the day when the
+        last pill from the last prescription fill was taken)."""
+        offsets = self.offsets
+        supply = self.supply
+        nDays = 0
+        for i in xrange(1, len(offsets)):
+            nDays += max(offsets[i] - offsets[i-1], supply[i-1])
+        return nDays + supply[-1]
+
+    def max_gap(self):
+        """ The longest time, in days, without pills between two fills."""
+        offsets = self.offsets
+        supply = self.supply
+        max_gap = 0.0
+        for i in xrange(1, len(offsets)):
+            gap = offsets[i] - offsets[i-1] - supply[i-1]
+            if gap > max_gap:
+                max_gap = gap
+        return max_gap
+
+    def __getstate__(self):
+        return (self.name, self.first, self.offsets, self.supply)
+
+    def __setstate__(self, state):
+        self.name, self.first, self.offsets, self.supply = state
+
+
+def refill_histories(patient_refill_data, drug='all'):
+    """ Returns the RefillHistory of each drug in the fulfillment rows (or
+    only of the given drug), sorted by drug name. If a drug was filled more
+    than once on the same date, the last of these rows is used."""
+    fills = {}
+    for data in patient_refill_data:
+        name = data[1]
+        if drug=='all' or drug==name:
+            fills.setdefault(name, {})[dates.iso_ordinal(data[3])] = int(data[2])
+
+    histories = []
+    for name in sorted(fills.keys()):
+        by_day = fills[name]
+        days = sorted(by_day.keys())
+        day0 = days[0]
+        histories.append(RefillHistory(name,
+                                       datetime.datetime.fromordinal(day0),
+                                       array('i', [day - day0 for day in days]),
+                                       array('h', [by_day[day] for day in days])))
+    return histories
+
+
+class DrugSummary(object):
+    """ The gap check result of one drug. tests holds the results of the
+    adherence tests, {test name: adherence_tests.TestResult}."""
+    __slots__ = ('name', 'urlname', 'flag', 'first', 'last', 'drug_class', 'nDays', 'mpr', 'tests')
+
+    def __init__(self, name, flag, first, last, drug_class, nDays, mpr, tests=None):
+        self.name = name
+        self.urlname = name.replace (" ", "%20")
+        self.flag = flag
+        self.first = first
+        self.last = last
+        self.drug_class = drug_class
+        self.nDays = nDays
+        self.mpr = mpr
+        self.tests = tests or {}
+
+    def row(self):
+        """ The list this result replaces, as a tuple."""
+        return (self.name, self.urlname, self.flag, self.first, self.last,
+                self.drug_class, self.nDays, self.mpr)
+
+    def __iter__(self):
+        return iter(self.row())
+
+    def __getitem__(self, i):
+        return self.row()[i]
+
+    def __len__(self):
+        return len(self.row())
+
+    def __repr__(self):
+        return "DrugSummary%r" % (self.row(),)
+
+    def __getstate__(self):
+        return self.row() + (self.tests,)
+
+    def __setstate__(self, state):
+        # Results pickled before the tests were kept have no tests
+        if len(state) == 8:
+            state = tuple(state) + ({},)
+        (self.name, self.urlname, self.flag, self.first, self.last,
+         self.drug_class, self.nDays, self.mpr, self.tests) = state
@@ -23,31 +23,33 @@
     $Log: views.py,v $
 """
 # Django imports.
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.template import Context
 from django.template.loader import get_template
 from django.template import RequestContext
 from django.utils import simplejson 
 from django.shortcuts import render_to_response
+from django.views.decorators.cache import cache_page
+from django.views.decorators.gzip import gzip_page
 
 # The SMArt API uses these libraries, all from smart_client_python
 import datetime
 import urllib
 import meds_adherence.settings as settings
-import smart_client.smart as smart
 import smart_client.oauth as oauth
+from smart_client_pool import SmartClientPool
 import adherence_check
+import adherence_cache
+import fetch
 
 
-# Basic configuration:  the consumer key and secret we'll use
-# to OAuth-sign requests.
-SMART_SERVER_OAUTH = {'consumer_key': '', 
-                      'consumer_secret': 'smartapp-secret'}
+# Basic configuration:  the consumer secret we'll use to OAuth-sign
+# requests. The consumer key (app id) and the SMArt container we talk to
+# come from the oauth header of each request.
+SMART_SERVER_OAUTH = {'consumer_secret': 'smartapp-secret'}
 
-# The SMArt container we're planning to talk to
-SMART_SERVER_PARAMS = {
-    'api_base' : ''
-}
+# SmartClients are reused by the requests made with the same credentials
+client_pool = SmartClientPool()
 
 # Global variables
 ISO_8601_DATETIME = '%Y-%m-%d'
@@ -70,7 +72,7 @@ def index(request):
         return "Couldn't find a parameter to match the name 'oauth_header'"
     
     # Current context information
-    oa_params, client = get_smart_client(smart_oauth_header)
+    oa_params = oauth.parse_header(smart_oauth_header)
     
     # User or physician and the patient name
     user = oa_params["smart_user_id"]
@@ -79,34 +81,19 @@ def index(request):
         
     # Represent the list as an RDF graph
     # Note the general pattern: GET /records/{record_id}/medications/
-    # Get the medication list for this context
-    medications = client.records_X_medications_GET()
-    query = """
-        PREFIX dcterms:<http://purl.org/dc/terms/>
-        PREFIX sp:<http://smartplatforms.org/terms#>
-        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-        SELECT  ?med ?name ?quant ?when
-        WHERE {
-            ?med rdf:type sp:Medication .
-            ?med sp:drugName ?medc.
-            ?medc dcterms:title ?name.
-            ?med sp:fulfillment ?fill.
-            ?fill sp:dispenseDaysSupply ?quant.
-            ?fill dcterms:date ?when.
-       }
-       """
-       
-    pills = medications.query(query)
-    birthday, patient_name = get_birthday_name(client)
-    drug = 'all'
+    # Get the medication list and the demographics for this context. The
+    # two requests are independent, so they are made at the same time (each
+    # with its own client).
+    with get_smart_client(oa_params) as client, get_smart_client(oa_params) as demographics_client:
+        pills, (birthday, patient_name) = fetch.fetch_concurrently([
+            ('medications', lambda: adherence_check.fetch_fulfillments(client)),
+            ('demographics', lambda: get_birthday_name(demographics_client)),
+        ])
+        drug = 'all'
     
-    # We only want to call the adherence_check once
-    if settings.PATIENT_ID == patientID:
-        meds_flags, gaps, refill_data, refill_day, actualMPR = settings.ADHERE_VARS
-    else:
-        settings.PATIENT_ID = patientID
-        meds_flags, gaps, refill_data, refill_day, actualMPR = adherence_check.all_tests(pills, drug, birthday)
-        settings.ADHERE_VARS = [meds_flags, gaps, refill_data, refill_day, actualMPR]
+        # We only want to call the adherence_check once per patient, until the
+        # medication data of the patient changes
+        meds_flags, gaps, refill_data, refill_day, actualMPR = get_adherence(client, pills, birthday, oa_params)
         
     drug_class_array = {}
     for n in range(len(meds_flags)):
@@ -129,26 +116,59 @@ def index(request):
 #===========================================
 
 #===========================================
-def get_smart_client(authorization_header, resource_tokens=None):
-    """ Initialize a new SmartClient"""
-    oa_params = oauth.parse_header(authorization_header)
-    
+def get_smart_client(oa_params):
+    """ Returns a SmartClient from the client pool for the given OAuth
+    parameters, to be used in a with statement"""
     resource_tokens={'oauth_token':       oa_params['smart_oauth_token'],
                      'oauth_token_secret':oa_params['smart_oauth_token_secret']}
                      
-    SMART_SERVER_PARAMS['api_base'] = oa_params['smart_container_api_base']
-    SMART_SERVER_OAUTH['consumer_key'] = oa_params['smart_app_id']
-
-    ret = smart.SmartClient(SMART_SERVER_OAUTH['consumer_key'], 
-                       SMART_SERVER_PARAMS, 
-                       SMART_SERVER_OAUTH, 
-                       resource_tokens)
-    ret.record_id=oa_params['smart_record_id']
-    return oa_params, ret
+    return client_pool.client(oa_params['smart_container_api_base'],
+                              oa_params['smart_app_id'],
+                              SMART_SERVER_OAUTH['consumer_secret'],
+                              resource_tokens,
+                              record_id=oa_params['smart_record_id'])
 
 
 #===========================================
 #===========================================
+def get_adherence(client, pills, birthday=None, oa_params=None):
+    """ Returns the adherence_check results for the patient of this client,
+    from the adherence cache unless the medication fulfillments have changed.
+    The birthday is only fetched if the results need to be computed. If the
+    OAuth parameters are given, the results are also remembered as the
+    latest ones of the record (see get_record_adherence)."""
+    key = adherence_cache.cache_key(client.record_id, pills)
+    adhere_vars = adherence_cache.lookup(key)
+    if adhere_vars is None:
+        if birthday is None:
+            birthday, patient_name = get_birthday_name(client)
+        adhere_vars = adherence_check.all_tests(pills, 'all', birthday)
+        adherence_cache.store(key, adhere_vars)
+    if oa_params is not None:
+        adherence_cache.store_record(record_cache_key(oa_params), key)
+    return adhere_vars
+
+def get_record_adherence(oa_params):
+    """ Returns the cache key and the adherence_check results for the record
+    of this context. The results computed for the index page are used as
+    long as they are recent; the container is only asked for the medication
+    list again when they are missing or stale."""
+    key = adherence_cache.latest_key(record_cache_key(oa_params))
+    adhere_vars = None
+    if key is not None:
+        adhere_vars = adherence_cache.lookup(key)
+    if adhere_vars is None:
+        with get_smart_client(oa_params) as client:
+            pills = adherence_check.fetch_fulfillments(client)
+            key = adherence_cache.cache_key(client.record_id, pills)
+            adhere_vars = get_adherence(client, pills, oa_params=oa_params)
+    return key, adhere_vars
+
+def record_cache_key(oa_params):
+    return adherence_cache.record_key(oa_params['smart_container_api_base'],
+                                      oa_params['smart_record_id'],
+                                      oa_params['smart_oauth_token'])
+
 #def update_pill_dates(med, name, quant, when):        
 #    def runs_out():
 #        print "Date", when
@@ -207,42 +227,20 @@ def risk(request):
         return "Couldn't find a parameter to match the name 'oauth_header'"
     
     # Current context information
-    oa_params, client = get_smart_client(smart_oauth_header)
+    oa_params = oauth.parse_header(smart_oauth_header)
     
     # User or physician and the patient name
 #    user = oa_params["smart_user_id"]
 #    patientID = oa_params["smart_record_id"]
        
-    # Get the medication list for this context
-    medications = client.records_X_medications_GET()
-    query = """
-        PREFIX dcterms:<http://purl.org/dc/terms/>
-        PREFIX sp:<http://smartplatforms.org/terms#>
-        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-        SELECT  ?med ?name ?quant ?when
-        WHERE {
-            ?med rdf:type sp:Medication .
-            ?med sp:drugName ?medc.
-            ?medc dcterms:title ?name.
-            ?med sp:fulfillment ?fill.
-            ?fill sp:dispenseDaysSupply ?quant.
-            ?fill dcterms:date ?when.
-       }
-       """    
-    pills = medications.query(query)
-    #birthday, patient_name = get_birthday_name(client)
-    
-    # The the fulfillment gap and MPR prediction data    
-    #meds_predict, predictedMPR, actualMPR = logR.gapPredict_logR(pills)
-    #meds_flags, gaps, refill_data, refill_day, actualMPR = gap_check.gap_check(pills, drug, birthday)
-    meds_flags, gaps, refill_data, refill_day, actualMPR = settings.ADHERE_VARS
+    # The fulfillment gap and MPR prediction data, normally already
+    # computed for the index page
+    key, (meds_flags, gaps, refill_data, refill_day, actualMPR) = get_record_adherence(oa_params)
 
     names = {}
     if drug == 'all':   # get all the drugs for this patient
-        for pill in pills: 
-            name = pill[1]
+        for name in actualMPR.keys():
             names[name] = name
-            d = pill[3]
     else: # only use the specified drug name
         meds_flags_new = []
         names[drug] = drug        
@@ -283,9 +281,6 @@ def risk(request):
                 'ad_data_js': simplejson.dumps(ad_data),
                 'med_names': med_names,
                 'meds_flags': meds_flags,
-                'refill_day': simplejson.dumps(refill_day),
-                'refill': simplejson.dumps(refill_data),
-                'gaps': simplejson.dumps(gaps),
                 'width': width,
                 'height': height,
                 'drug_class_array': sorted_drug_class_array,
@@ -294,6 +289,36 @@ def risk(request):
     response = render_to_response("risk.html", context_instance=variables )
     return HttpResponse(response)
 
+@gzip_page
+def risk_json(request):
+    """ Serves the series plotted in the risk page (MPR time series, gaps
+    and refill days) as JSON, for one drug or for 'all' of them (see
+    adherence_check.risk_series). The ETag is the key of the cached adherence result, so the browser can
+    keep the response until the medication data of the patient changes."""
+    drug = request.GET.get('drug', 'all')
+
+    try:
+        smart_oauth_header_quoted = request.GET.get('oauth_header')
+        smart_oauth_header = urllib.unquote(smart_oauth_header_quoted)
+    except:
+        return "Couldn't find a parameter to match the name 'oauth_header'"
+
+    oa_params = oauth.parse_header(smart_oauth_header)
+    key, adhere_vars = get_record_adherence(oa_params)
+
+    etag = '"%s"' % key
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        series = adherence_check.risk_series(adhere_vars, drug)
+        response = HttpResponse(simplejson.dumps(series), mimetype='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=%d' % adherence_cache.stale_after()
+    return response
+
+# The about and choose_med pages only depend on the oauth header, which is
+# part of the URL, so the rendered pages are cached by URL.
+@cache_page(settings.STATIC_PAGE_CACHE_TIMEOUT)
 def about(request):
     """ This function creates a page with information about the med adherence application."""
     page = get_template('about.html')
@@ -304,13 +329,17 @@ def about(request):
     except:
         return "Couldn't find a parameter to match the name 'oauth_header'"
         
+    # The body of the page does not depend on the session: it is also
+    # cached as a fragment, shared by all the oauth headers
     variables = Context({
         'oauth_header': urllib.quote(smart_oauth_header),
+        'cache_timeout': settings.STATIC_PAGE_CACHE_TIMEOUT,
     })
     
     output = page.render(variables)
     return HttpResponse(output)
 
+@cache_page(settings.STATIC_PAGE_CACHE_TIMEOUT)
 def choose_med(request):
     """ This function creates a page with instructions for the med adherence application."""
     page = get_template('choose_med.html')
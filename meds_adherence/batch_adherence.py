@@ -0,0 +1,196 @@
+"""
+    File: batch_adherence.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Batch job that runs the medication adherence tests (gap check and
+    logistic prediction) for every record in a SMArt container, e.g. as a
+    nightly cron job. The medication fulfillments of each record are fetched
+    by this process while a pool of worker processes scores the records
+    already fetched. The flags of every drug are written to a SQLite
+    database (settings.ADHERENCE_BATCH_DB), one row per (record, drug).
+
+    The state of every drug after its last fill is saved in the same
+    database, and the next run only processes the fills added since then
+    (see MedCheck/drug_state.py). --full ignores the saved states.
+
+    Usage:
+
+        python batch_adherence.py [--workers N] [--db FILE] [--full]
+
+    The container and the credentials of the background app are configured
+    by settings.ADHERENCE_BATCH_API_BASE and settings.ADHERENCE_BATCH_OAUTH.
+"""
+
+import argparse
+import collections
+import cPickle as pickle
+import datetime
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+
+# The MedCheck modules are imported as in the Django project: the project
+# directory and its parent need to be on the path.
+abspath = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(abspath)
+sys.path.append(os.path.dirname(abspath))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'meds_adherence.settings')
+
+from django.conf import settings
+from smart_client.smart import SmartClient
+from MedCheck import adherence_check
+from MedCheck.views import get_birthday_name
+
+# Number of results written between two commits to the database
+COMMIT_EVERY = 500
+
+# Number of records per worker process sent to the pool and not scored yet
+PENDING_PER_WORKER = 4
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS adherence_flags (
+        record_id   TEXT NOT NULL,
+        drug        TEXT NOT NULL,
+        drug_class  TEXT,
+        flag        INTEGER,
+        mpr         REAL,
+        ndays       INTEGER,
+        first_fill  TEXT,
+        last_fill   TEXT,
+        scored_at   TEXT,
+        PRIMARY KEY (record_id, drug)
+    )
+    """
+
+CREATE_STATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS adherence_state (
+        record_id   TEXT NOT NULL,
+        drug        TEXT NOT NULL,
+        state       BLOB,
+        PRIMARY KEY (record_id, drug)
+    )
+    """
+
+def get_smart_client(resource_tokens=None):
+    ret = SmartClient(settings.ADHERENCE_BATCH_OAUTH['consumer_key'],
+                      {'api_base': settings.ADHERENCE_BATCH_API_BASE},
+                      settings.ADHERENCE_BATCH_OAUTH,
+                      resource_tokens)
+    return ret
+
+def fetch_records(smart_client, db, full):
+    """ Yields (record_id, fulfillments, birthday, states) for every record.
+    The fulfillments are plain strings, so that they can be sent to the
+    worker processes, and states are the drug states saved by the last run."""
+    for record_id in smart_client.loop_over_records():
+        try:
+            pills = adherence_check.fetch_fulfillments(smart_client)
+            if not pills:
+                continue
+            birthday, patient_name = get_birthday_name(smart_client)
+        except Exception, e:
+            print "Unable to fetch record", record_id, ":", e
+            continue
+        states = {}
+        if not full:
+            states = load_states(db, record_id)
+        yield record_id, pills, unicode(birthday), states
+
+def score_record(args):
+    """ Runs the adherence tests for one record (in a worker process).
+    Returns (record_id, meds_flags, states, error)."""
+    record_id, pills, birthday, states = args
+    try:
+        meds_flags, states = adherence_check.incremental_tests(pills, 'all', birthday, states)
+    except Exception:
+        return record_id, None, None, traceback.format_exc()
+    return record_id, meds_flags, states, None
+
+def open_store(filename):
+    db = sqlite3.connect(filename)
+    db.execute(CREATE_TABLE)
+    db.execute(CREATE_STATE_TABLE)
+    return db
+
+def load_states(db, record_id):
+    rows = db.execute("SELECT drug, state FROM adherence_state WHERE record_id = ?", (record_id,))
+    return dict((drug, pickle.loads(str(state))) for drug, state in rows)
+
+def save_states(db, record_id, states):
+    db.execute("DELETE FROM adherence_state WHERE record_id = ?", (record_id,))
+    db.executemany("INSERT INTO adherence_state VALUES (?,?,?)",
+                   [(record_id, drug, buffer(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+                    for drug, state in states.items()])
+
+def save_flags(db, record_id, meds_flags, scored_at):
+    db.execute("DELETE FROM adherence_flags WHERE record_id = ?", (record_id,))
+    db.executemany("INSERT INTO adherence_flags VALUES (?,?,?,?,?,?,?,?,?)",
+                   [(record_id, name, drug_class, flag, mpr, nDays,
+                     first.date().isoformat(), last.date().isoformat(), scored_at)
+                    for name, urlname, flag, first, last, drug_class, nDays, mpr in meds_flags])
+
+def score_all_records(workers, dbfile, full=False):
+    """ Scores every record of the container. The records are fetched by
+    this thread and sent to the worker pool, at most PENDING_PER_WORKER per
+    worker ahead of the results. An error while fetching the records (other
+    than in a single record) ends the run with that exception."""
+    db = open_store(dbfile)
+    pool = multiprocessing.Pool(workers)
+    scored_at = datetime.datetime.now().isoformat()
+    start = time.time()
+    counts = {'records': 0, 'errors': 0}
+    pending = collections.deque()
+
+    def save_result(result):
+        record_id, meds_flags, states, error = result.get()
+        if error is not None:
+            counts['errors'] += 1
+            print "Unable to score record", record_id
+            print error
+            return
+        save_flags(db, record_id, meds_flags, scored_at)
+        save_states(db, record_id, states)
+        counts['records'] += 1
+        if counts['records'] % COMMIT_EVERY == 0:
+            db.commit()
+            print "Scored %d records (%.1f records/s)" % (counts['records'],
+                                                           counts['records'] / (time.time() - start))
+
+    try:
+        for record in fetch_records(get_smart_client(), db, full):
+            pending.append(pool.apply_async(score_record, (record,)))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                save_result(pending.popleft())
+        while pending:
+            save_result(pending.popleft())
+        db.commit()
+        pool.close()
+    except:
+        # Do not wait for the records still being scored
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        db.close()
+    print "Scored %d records in %.1f s, %d errors" % (counts['records'], time.time() - start,
+                                                      counts['errors'])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Score the medication adherence of all records.')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--db', default=settings.ADHERENCE_BATCH_DB,
+                        help='SQLite database the results are written to')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every drug from its first fill')
+    args = parser.parse_args()
+    score_all_records(args.workers, args.db, args.full)
@@ -0,0 +1,80 @@
+"""
+    File: bench_dates.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Compares datetime.strptime with the memoized ISO date parser of
+    MedCheck/dates.py on the fulfillment dates of a synthetic record (10
+    drugs with 1000 fills each, i.e. 10k fulfillments, by default), first
+    for the dates alone and then for building the refill histories of the
+    record, which is where the gap check parses them.
+
+    Usage:
+
+        python bench_dates.py [--meds N] [--fills N] [--repeat N]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(abspath), 'MedCheck'))
+
+import dates
+import med_parser
+import refill_history
+import synthetic
+from common import best_time
+
+ISO_8601_DATETIME = '%Y-%m-%d'
+
+def strptime_ordinals(rows):
+    return [datetime.datetime.strptime(str(row[3]), ISO_8601_DATETIME).toordinal() for row in rows]
+
+def iso_ordinals(rows):
+    dates._memo.clear()
+    return [dates.iso_ordinal(row[3]) for row in rows]
+
+def strptime_histories(rows):
+    # refill_histories as it was with strptime
+    fills = {}
+    for data in rows:
+        d = datetime.datetime.strptime(str(data[3]), ISO_8601_DATETIME)
+        fills.setdefault(data[1], {})[d.toordinal()] = int(data[2])
+    return fills
+
+def iso_histories(rows):
+    dates._memo.clear()
+    return refill_history.refill_histories(rows)
+
+def main(nmeds, nfills, repeat):
+    rows = med_parser.parse_fulfillments(synthetic.medication_list('1000000', nmeds, nfills))
+    print "%d fulfillments, %d distinct dates" % (len(rows), len(set(row[3] for row in rows)))
+
+    old, expected = best_time(strptime_ordinals, (rows,), repeat)
+    new, ordinals = best_time(iso_ordinals, (rows,), repeat)
+    if ordinals != expected:
+        print "dates.iso_ordinal and strptime differ"
+        sys.exit(1)
+    print "%-22s %10s %10s %8s" % ("", "strptime ms", "dates ms", "speedup")
+    print "%-22s %10.1f %10.1f %7.1fx" % ("parse dates", old * 1000, new * 1000, old / new)
+
+    old, fills = best_time(strptime_histories, (rows,), repeat)
+    new, histories = best_time(iso_histories, (rows,), repeat)
+    print "%-22s %10.1f %10.1f %7.1fx" % ("refill histories", old * 1000, new * 1000, old / new)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the ISO date parsers.')
+    parser.add_argument('--meds', type=int, default=10, help='number of drugs')
+    parser.add_argument('--fills', type=int, default=1000, help='number of fulfillments per drug')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per parser (best is kept)')
+    args = parser.parse_args()
+    main(args.meds, args.fills, args.repeat)
@@ -0,0 +1,75 @@
+"""
+    File: bench_med_parser.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Compares the two ways of extracting the medication fulfillments from
+    the medication list of a record: the streaming parser (med_parser) and
+    the rdflib graph with the SPARQL query (FULFILLMENT_QUERY), on synthetic
+    records of increasing size. Both must return the same rows.
+
+    Usage:
+
+        python bench_med_parser.py [--meds N] [--fills N,N,...] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(abspath), 'MedCheck'))
+
+import rdflib
+import med_parser
+import synthetic
+from common import best_time
+
+# Same query as adherence_check.FULFILLMENT_QUERY (adherence_check needs
+# the Django settings)
+FULFILLMENT_QUERY = """
+    PREFIX dcterms:<http://purl.org/dc/terms/>
+    PREFIX sp:<http://smartplatforms.org/terms#>
+    PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+    SELECT  ?med ?name ?quant ?when
+    WHERE {
+        ?med rdf:type sp:Medication .
+        ?med sp:drugName ?medc.
+        ?medc dcterms:title ?name.
+        ?med sp:fulfillment ?fill.
+        ?fill sp:dispenseDaysSupply ?quant.
+        ?fill dcterms:date ?when.
+   }
+   """
+
+def sparql_fulfillments(rdfxml):
+    medications = rdflib.ConjunctiveGraph()
+    medications.parse(data=rdfxml, format="xml")
+    return [tuple(unicode(x) for x in pill) for pill in medications.query(FULFILLMENT_QUERY)]
+
+def main(nmeds, fills, repeat):
+    print "%6s %8s %10s %10s %10s %8s" % ("fills", "rows", "KB", "sparql ms", "stream ms", "speedup")
+    for nfills in fills:
+        rdfxml = synthetic.medication_list('1000000', nmeds, nfills)
+        sparql, expected = best_time(sparql_fulfillments, (rdfxml,), repeat)
+        stream, rows = best_time(med_parser.parse_fulfillments, (rdfxml,), repeat)
+        if sorted(rows) != sorted(expected):
+            print "The streaming parser and the SPARQL query differ for %d fills" % nfills
+            sys.exit(1)
+        print "%6d %8d %10.1f %10.1f %10.2f %7.0fx" % (nfills, len(rows), len(rdfxml) / 1024.0,
+                                                     sparql * 1000, stream * 1000, sparql / stream)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the medication list parsers.')
+    parser.add_argument('--meds', type=int, default=5, help='number of drugs per record')
+    parser.add_argument('--fills', default='5,20,100,500',
+                        help='comma separated numbers of fulfillments per drug')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size (best is kept)')
+    args = parser.parse_args()
+    main(args.meds, [int(n) for n in args.fills.split(',')], args.repeat)
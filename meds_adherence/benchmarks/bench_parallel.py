@@ -0,0 +1,83 @@
+"""
+    File: bench_parallel.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Compares the gap check of one synthetic patient (see synthetic.py) run
+    drug after drug in this process with the same check run one drug per
+    task in a pool of worker processes, for the dense and the breakpoint mpr
+    series. The total number of days of the drug histories is reported with
+    the choice gap_check makes on its own (GAP_CHECK_PARALLEL_DAYS), which
+    this benchmark helps to set for the machine MedCheck runs on.
+
+    Usage:
+
+        python bench_parallel.py [--meds N] [--days N] [--workers N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+
+# The MedCheck modules are imported as in the Django project: the project
+# directory and its parent need to be on the path.
+abspath = os.path.dirname(os.path.abspath(__file__))
+project = os.path.dirname(abspath)
+sys.path.append(os.path.join(project, 'MedCheck'))
+sys.path.append(project)
+sys.path.append(os.path.dirname(project))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'meds_adherence.settings')
+
+import multiprocessing
+from django.conf import settings
+import drug_classes
+import gap_check
+import med_parser
+import refill_history
+import synthetic
+from common import best_time, quiet
+
+BIRTHDAY = '1950-03-04'
+
+def check(pills, classes, series, pool):
+    with quiet():
+        return gap_check.gap_check(pills, 'all', BIRTHDAY, classes, series, None, pool)
+
+def main(args):
+    pills = med_parser.parse_fulfillments(synthetic.medication_list('1000000', args.meds, days=args.days))
+    classes = drug_classes.get_drug_classes(settings.MEDIA_ROOT + "drugClass.xls")
+    histories = refill_history.refill_histories(pills)
+    total_days = sum(history.nDays() for history in histories)
+    print "%d drugs, %d fulfillments, %d days in all (GAP_CHECK_PARALLEL_DAYS = %d)" % (
+        len(histories), len(pills), total_days, settings.GAP_CHECK_PARALLEL_DAYS)
+
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        print "%-12s %14s %10s %8s  %s" % ("series", "sequential ms", "pool ms", "speedup", "gap_check uses")
+        for series in ['dense', 'breakpoints']:
+            sequential, expected = best_time(check, (pills, classes, series, False), args.repeat)
+            parallel, result = best_time(check, (pills, classes, series, pool), args.repeat)
+            if result[1:] != expected[1:] or map(list, result[0]) != map(list, expected[0]):
+                print "The pool and the sequential gap check differ"
+                sys.exit(1)
+            choice = gap_check.parallel_pays_off(histories, series) and "pool" or "sequential"
+            print "%-12s %14.1f %10.1f %7.2fx  %s" % (series, sequential * 1000, parallel * 1000,
+                                                      sequential / parallel, choice)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the gap check in worker processes.')
+    parser.add_argument('--meds', type=int, default=20, help='number of drugs')
+    parser.add_argument('--days', type=int, default=1825, help='length of the histories in days')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per mode (best is kept)')
+    main(parser.parse_args())
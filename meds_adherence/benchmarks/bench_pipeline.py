@@ -0,0 +1,192 @@
+"""
+    File: bench_pipeline.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Benchmark of the MedCheck adherence pipeline on synthetic records
+    (see synthetic.py). Each stage is timed separately over all the records:
+
+        parse        medication list RDF/XML -> fulfillment rows (med_parser)
+        histories    fulfillment rows -> refill histories, nDays, largest gap
+        mpr dense    day by day mpr series of every drug (mpr_engine)
+        mpr breaks   breakpoint mpr series of every drug (mpr_engine)
+        prediction   logistic regression at 60, 90 and 120 days
+        all_tests    the whole adherence check, as the index page runs it
+        json         serialization of the risk chart series (as risk.json)
+
+    For each stage the best time of --repeat runs is reported with the
+    throughput in records and fulfillments per second, and the peak memory
+    (maximum resident set size) of the process after the stage.
+
+    The results can be saved with --save and compared with a saved run with
+    --compare: the benchmark then fails (exit status 1) if a stage is more
+    than --tolerance slower than in the saved run.
+
+    Usage:
+
+        python bench_pipeline.py [--records N] [--meds N] [--fills N | --days N]
+                                 [--supply N] [--gap-probability P] [--repeat N]
+                                 [--save FILE] [--compare FILE] [--tolerance T]
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+
+# The MedCheck modules are imported as in the Django project: the project
+# directory and its parent need to be on the path.
+abspath = os.path.dirname(os.path.abspath(__file__))
+project = os.path.dirname(abspath)
+sys.path.append(os.path.join(project, 'MedCheck'))
+sys.path.append(project)
+sys.path.append(os.path.dirname(project))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'meds_adherence.settings')
+
+from django.conf import settings
+from django.utils import simplejson
+import adherence_check
+import adherence_predict
+import adherence_tests
+import drug_classes
+import drug_names
+import med_parser
+import mpr_engine
+import refill_history
+import synthetic
+from common import best_time, quiet
+
+BIRTHDAY = '1950-03-04'
+
+def stage_parse(documents):
+    return [med_parser.parse_fulfillments(rdfxml) for rdfxml in documents]
+
+def stage_histories(records):
+    result = []
+    for pills in records:
+        histories = refill_history.refill_histories(pills)
+        for history in histories:
+            history.nDays()
+            history.max_gap()
+        result.append(histories)
+    return result
+
+def stage_mpr_dense(histories):
+    for record in histories:
+        for history in record:
+            nDays = history.nDays()
+            mpr, gaps, refill_day = mpr_engine.mpr_series(history.offsets, history.supply, nDays)
+            mpr_engine.mpr_tseries(mpr, gaps)
+
+def stage_mpr_breakpoints(histories):
+    for record in histories:
+        for history in record:
+            nDays = history.nDays()
+            events = mpr_engine.mpr_events(history.offsets, history.supply, nDays)
+            mpr_engine.mpr_breakpoints(events, nDays, settings.MPR_SERIES_STEP)
+
+def stage_prediction(histories, adherence):
+    for record in histories:
+        for history in record:
+            nDays = history.nDays()
+            events = mpr_engine.mpr_events(history.offsets, history.supply, nDays)
+            mpr_on = lambda day: mpr_engine.mpr_at(events, day)
+            adherence_tests.predict_adherence(adherence, history.name, 50, nDays, mpr_on)
+
+def stage_all_tests(records):
+    with quiet():
+        return [adherence_check.all_tests(pills, 'all', BIRTHDAY) for pills in records]
+
+def stage_json(results):
+    for adhere_vars in results:
+        simplejson.dumps(adherence_check.risk_series(adhere_vars))
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run(args):
+    documents = [rdfxml for record_id, rdfxml in
+                 synthetic.records(args.records, args.meds, args.fills, args.supply,
+                                   args.gap_probability, args.days)]
+    classes = drug_classes.get_drug_classes(settings.MEDIA_ROOT + "drugClass.xls")
+    adherence = adherence_predict.adherence_predict(settings.MEDIA_ROOT + "genLinearModel.txt", classes)
+
+    results = []
+    def stage(name, function, *stage_args):
+        seconds, result = best_time(function, stage_args, args.repeat)
+        results.append((name, seconds, max_rss_mb()))
+        return result
+
+    records = stage('parse', stage_parse, documents)
+    nfills = sum(len(pills) for pills in records)
+    histories = stage('histories', stage_histories, records)
+    stage('mpr dense', stage_mpr_dense, histories)
+    stage('mpr breaks', stage_mpr_breakpoints, histories)
+    stage('prediction', stage_prediction, histories, adherence)
+    adhere_vars = stage('all_tests', stage_all_tests, records)
+    stage('json', stage_json, adhere_vars)
+    return nfills, results
+
+def report(args, nfills, results, baseline):
+    print "%d records, %d drugs, %d fulfillments (MPR_SERIES = %s)" % (
+        args.records, args.records * args.meds, nfills, getattr(settings, 'MPR_SERIES', 'dense'))
+    print "%-12s %10s %12s %14s %10s %10s" % ("stage", "ms", "records/s", "fills/s", "max RSS MB", "vs saved")
+    slower = []
+    for name, seconds, rss in results:
+        change = ""
+        if baseline is not None and name in baseline:
+            ratio = seconds / baseline[name]
+            change = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + args.tolerance:
+                slower.append(name)
+        print "%-12s %10.1f %12.1f %14.0f %10.1f %10s" % (name, seconds * 1000, args.records / seconds,
+                                                         nfills / seconds, rss, change)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MedCheck adherence pipeline.')
+    parser.add_argument('--records', type=int, default=50, help='number of synthetic records')
+    parser.add_argument('--meds', type=int, default=5, help='number of drugs per record')
+    parser.add_argument('--fills', type=int, default=40, help='number of fulfillments per drug')
+    parser.add_argument('--days', type=int, help='length of the histories in days (instead of --fills)')
+    parser.add_argument('--supply', type=int, help='days supply of every fill (default: 30 to 90)')
+    parser.add_argument('--gap-probability', type=float, default=0.1,
+                        help='probability that a refill is late')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage (best is kept)')
+    parser.add_argument('--save', help='write the stage times to this JSON file')
+    parser.add_argument('--compare', help='compare the stage times with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown allowed by --compare (default: 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        f = open(args.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+    nfills, results = run(args)
+    slower = report(args, nfills, results, baseline)
+    print "drug names: %(hits)d memo hits, %(misses)d misses" % drug_names.memo_stats()
+
+    if args.save:
+        f = open(args.save, 'w')
+        try:
+            json.dump(dict((name, seconds) for name, seconds, rss in results), f, indent=1)
+        finally:
+            f.close()
+    if slower:
+        print "Slower than the saved run: %s" % ", ".join(slower)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+    File: common.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Helpers shared by the MedCheck benchmarks: timing a function over
+    several runs and silencing what the adherence tests print.
+"""
+
+import os
+import sys
+import time
+
+class quiet():
+    """ Discards what gap_check prints for every drug."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def best_time(function, args, repeat):
+    """ Calls function(*args) repeat times. Returns the best time in seconds
+    and the result of the last call."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
@@ -0,0 +1,149 @@
+"""
+    File: synthetic.py
+
+    Children's Hospital Boston Informatics Program
+    300 Longwood Avenue
+    Boston, MA 02115
+
+    Purpose:
+
+    Synthetic SMArt patient records for the MedCheck benchmarks. A record is
+    a medication list written as RDF/XML the way the SMArt container writes
+    it (sp:Medication nodes with nested sp:drugName and sp:fulfillment
+    nodes), with drug names taken from Media/drugClass.json so that the
+    adherence tests find their drug class. The records are reproducible:
+    the same record id and parameters always give the same document.
+
+    Each drug is refilled around the time its supply runs out; the days
+    supply of the fills (the refill cadence), the probability of a late
+    refill (leaving a gap) and the length of the history are configurable.
+
+    Usage:
+
+        python synthetic.py [--meds N] [--fills N | --days N] [--supply N]
+                            [--gap-probability P] [record_id]
+
+    writes one record to stdout.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+from xml.sax.saxutils import escape
+
+MEDIA_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Media')
+
+RDF_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF
+  xmlns:sp="http://smartplatforms.org/terms#"
+  xmlns:dcterms="http://purl.org/dc/terms/"
+  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+>
+"""
+
+MEDICATION = """  <sp:Medication rdf:about="http://sandbox-api.smartplatforms.org/records/%(record_id)s/medications/%(med)d">
+    <sp:belongsTo rdf:resource="http://sandbox-api.smartplatforms.org/records/%(record_id)s"/>
+    <sp:drugName>
+      <sp:CodedValue>
+        <dcterms:title>%(title)s</dcterms:title>
+        <sp:code rdf:resource="http://link.informatics.stonybrook.edu/rxnorm/RXCUI/%(rxcui)d"/>
+      </sp:CodedValue>
+    </sp:drugName>
+    <sp:instructions>1 daily</sp:instructions>
+    <sp:quantity>
+      <sp:ValueAndUnit>
+        <sp:unit>{tablet}</sp:unit>
+        <sp:value>1</sp:value>
+      </sp:ValueAndUnit>
+    </sp:quantity>
+    <sp:startDate>%(start)s</sp:startDate>
+"""
+
+FULFILLMENT = """    <sp:fulfillment>
+      <sp:Fulfillment rdf:about="http://sandbox-api.smartplatforms.org/records/%(record_id)s/fulfillments/%(med)d-%(fill)d">
+        <sp:belongsTo rdf:resource="http://sandbox-api.smartplatforms.org/records/%(record_id)s"/>
+        <dcterms:date>%(date)s</dcterms:date>
+        <sp:dispenseDaysSupply>%(supply)d</sp:dispenseDaysSupply>
+        <sp:dispenseQuantity>%(supply)d</sp:dispenseQuantity>
+      </sp:Fulfillment>
+    </sp:fulfillment>
+"""
+
+DOSES = ['10 MG Oral Tablet', '20 MG Oral Tablet', '5 MG Oral Tablet', '500 MG Oral Tablet']
+SUPPLIES = [30, 30, 30, 60, 90, 90]
+FIRST_FILL = datetime.date(2005, 1, 1)
+
+_drug_names = None
+
+def drug_names():
+    """ The drug names of the drug class table, sorted."""
+    global _drug_names
+    if _drug_names is None:
+        f = open(os.path.join(MEDIA_ROOT, 'drugClass.json'))
+        try:
+            _drug_names = sorted(json.load(f)['drug_classes'])
+        finally:
+            f.close()
+    return _drug_names
+
+def refills(rng, nfills, supply=None, gap_probability=0.1, days=None):
+    """ Yields (date, days supply) for the fulfillments of one drug: nfills
+    of them, or as many as fit in a history of the given number of days.
+    Each fill is for the given days supply (by default one of SUPPLIES).
+    Most refills come around the time the previous supply runs out; with
+    gap_probability they come late, leaving a gap."""
+    first = day = FIRST_FILL + datetime.timedelta(rng.randint(0, 365))
+    n = 0
+    while (days is None and n < nfills) or (days is not None and (day - first).days < days):
+        q = supply or rng.choice(SUPPLIES)
+        yield day, q
+        n += 1
+        if rng.random() < gap_probability:
+            delay = rng.randint(q + 30, q + 120)
+        else:
+            delay = rng.randint(max(q - 5, 1), q + 10)
+        day += datetime.timedelta(delay)
+
+def medication_list(record_id, nmeds=5, nfills=20, supply=None, gap_probability=0.1, days=None):
+    """ Returns the RDF/XML medication list of a synthetic record with nmeds
+    drugs, each filled nfills times (or during the given number of days).
+    See refills for the other parameters."""
+    rng = random.Random(record_id)
+    names = drug_names()
+    out = [RDF_HEADER]
+    for med in range(nmeds):
+        fills = list(refills(rng, nfills, supply, gap_probability, days))
+        title = "%s %s" % (rng.choice(names).capitalize(), rng.choice(DOSES))
+        out.append(MEDICATION % {'record_id': record_id, 'med': med,
+                                 'title': escape(title),
+                                 'rxcui': rng.randint(100000, 999999),
+                                 'start': fills[0][0].isoformat()})
+        for fill, (date, q) in enumerate(fills):
+            out.append(FULFILLMENT % {'record_id': record_id, 'med': med, 'fill': fill,
+                                      'date': date.isoformat(), 'supply': q})
+        out.append("  </sp:Medication>\n")
+    out.append("</rdf:RDF>\n")
+    return ''.join(out)
+
+def records(nrecords, nmeds=5, nfills=20, supply=None, gap_probability=0.1, days=None):
+    """ Yields (record_id, medication list) for nrecords synthetic records."""
+    for i in range(nrecords):
+        record_id = str(1000000 + i)
+        yield record_id, medication_list(record_id, nmeds, nfills, supply, gap_probability, days)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Write a synthetic medication list.')
+    parser.add_argument('--meds', type=int, default=5, help='number of drugs')
+    parser.add_argument('--fills', type=int, default=20, help='number of fulfillments per drug')
+    parser.add_argument('--days', type=int, help='length of the history in days (instead of --fills)')
+    parser.add_argument('--supply', type=int, help='days supply of every fill')
+    parser.add_argument('--gap-probability', type=float, default=0.1,
+                        help='probability that a refill is late')
+    parser.add_argument('record_id', nargs='?', default='1000000')
+    args = parser.parse_args()
+    print medication_list(args.record_id, args.meds, args.fills, args.supply,
+                          args.gap_probability, args.days),
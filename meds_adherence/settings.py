@@ -74,9 +74,44 @@ USE_L10N = True
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(SITE_ROOT, 'Media/')
 
-# Some global variables that i want to use in views.py
-PATIENT_ID = 0
-ADHERE_VARS = [0,0,0,0,0]
+# Cache of the adherence results of each patient (see MedCheck/adherence_cache.py).
+# BACKEND is 'locmem' (this process), 'django' (the Django cache framework) or
+# 'file' (pickle files in LOCATION). TIMEOUT is in seconds. The drill-down
+# pages reuse the last result of a record without asking the container for
+# the medication list again for STALE_AFTER seconds.
+ADHERENCE_CACHE = {
+    'BACKEND': 'locmem',
+    'LOCATION': os.path.join(SITE_ROOT, 'adherence_cache'),
+    'MAX_ENTRIES': 200,
+    'TIMEOUT': 3600,
+    'STALE_AFTER': 300,
+}
+
+# The MPR curves plotted in risk.html are either computed for every day
+# ('dense') or only at the refills, supply exhaustion days and gap ends
+# ('breakpoints'), with an extra point every MPR_SERIES_STEP days (0 for none).
+# The gaps are listed day by day either way.
+MPR_SERIES = 'breakpoints'
+MPR_SERIES_STEP = 7
+
+# With the 'breakpoints' series, the adherence tests of a patient whose drug
+# histories add up to at least GAP_CHECK_PARALLEL_DAYS days can be run one
+# drug per task in a pool of GAP_CHECK_WORKERS processes (None for the
+# number of CPUs). The pool is off (0) by default: it is started from the
+# process serving the requests, so only turn it on if
+# benchmarks/bench_parallel.py shows a speedup on the server.
+GAP_CHECK_WORKERS = 0
+GAP_CHECK_PARALLEL_DAYS = 200000
+
+# Nightly adherence scoring of all records (batch_adherence.py): the SMArt
+# container, the credentials of the background app and the SQLite database
+# the results are written to.
+ADHERENCE_BATCH_API_BASE = 'http://localhost:7000'
+ADHERENCE_BATCH_OAUTH = {
+    'consumer_key': 'smart-connector@apps.smartplatforms.org',
+    'consumer_secret': 'smartapp-secret'
+}
+ADHERENCE_BATCH_DB = os.path.join(SITE_ROOT, 'adherence_batch.db')
 
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
@@ -86,6 +121,11 @@ MEDIA_URL = 'http://localhost:8000/static/'
 # The base URI for the NDF-RT drug information database web service
 NDF_RT = 'http://rxnav.nlm.nih.gov/REST/Ndfrt/version/'
 
+# Local drug class index compiled from an NDF-RT dump (see
+# MedCheck/ndfrt_index.py). The drugs that are not in it, or all of them if
+# the file does not exist, get their class from Media/drugClass.xls.
+NDF_RT_INDEX = os.path.join(MEDIA_ROOT, 'ndfrt_index.txt')
+
 # Absolute path to the directory static files should be collected to.
 # Don't put anything in this directory yourself; store your static files
 # in apps' "static/" subdirectories and in STATICFILES_DIRS.
@@ -120,12 +160,29 @@ STATICFILES_FINDERS = (
 SECRET_KEY = '_2%_03e2$%36(7%__wryy=fcppgh_wvgi0*)4c!i5uhh=nqvut'
 
 # List of callables that know how to import templates from various sources.
+# The cached loader compiles each template once per process (restart the
+# server to see changes to a template).
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.Loader',
-    'django.template.loaders.app_directories.Loader',
-#     'django.template.loaders.eggs.Loader',
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+#         'django.template.loaders.eggs.Loader',
+    )),
 )
 
+# Cache used for the rendered static pages (about, choose_med) and the
+# static fragments of the templates.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 3600,
+    }
+}
+
+# Number of seconds the about and choose_med pages (and the body of the
+# about page, cached on its own) are kept by the cache
+STATIC_PAGE_CACHE_TIMEOUT = 3600
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -168,6 +225,10 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -176,5 +237,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Timing of the calls to the SMArt container (MedCheck/fetch.py)
+        'MedCheck.fetch': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
@@ -24,7 +24,7 @@
 """
 
 from django.conf.urls.defaults import patterns
-from MedCheck.views import index, risk, about, choose_med
+from MedCheck.views import index, risk, risk_json, about, choose_med
 import settings
 
 # A typical urlconf entry looks like this:
@@ -41,6 +41,7 @@ urlpatterns = patterns('',
     
     # List of all patients, indicating those with potential adherence issues
     (r'^smartapp/risk.html$', risk),
+    (r'^smartapp/risk.json$', risk_json),
     (r'^smartapp/about.html$', about),
     (r'^smartapp/choose_med.html$', choose_med),
     
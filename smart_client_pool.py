@@ -0,0 +1,93 @@
+"""
+Pool of SmartClients shared by the requests of a SMArt app.
+
+Building a SmartClient for every request also builds a new OAuth consumer
+and connection state. The pool keeps idle clients keyed by container
+(api_base), app (consumer key) and access token, and hands them out again
+to later requests made with the same credentials, so that the client and
+its connection are reused for the requests of an app session.
+
+A client is used by one request at a time: it is checked out of the pool
+for the duration of a with statement and returned afterwards. A client
+whose block raised an exception is dropped, since its connection may be
+in an unknown state.
+
+    pool = SmartClientPool()
+    with pool.client(api_base, consumer_key, consumer_secret, tokens) as c:
+        c.records_X_medications_GET()
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from smart_client.smart import SmartClient
+
+class SmartClientPool(object):
+
+    def __init__(self, max_idle=64, max_idle_per_key=4):
+        """max_idle bounds the total number of idle clients kept and
+        max_idle_per_key the number kept for the same credentials"""
+        self.max_idle = max_idle
+        self.max_idle_per_key = max_idle_per_key
+        self.idle = OrderedDict()   # key -> [clients], least recently used first
+        self.nidle = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def client(self, api_base, consumer_key, consumer_secret, resource_tokens=None, **attributes):
+        """Checks out a client for the given credentials for the duration
+        of a with statement. The keyword arguments (e.g. record_id) are set
+        as attributes of the client."""
+        key = self.key(api_base, consumer_key, consumer_secret, resource_tokens)
+        client = self.checkout(key)
+        if client is None:
+            client = SmartClient(consumer_key,
+                                 {'api_base': api_base},
+                                 {'consumer_key': consumer_key,
+                                  'consumer_secret': consumer_secret},
+                                 resource_tokens)
+        for name, value in attributes.items():
+            setattr(client, name, value)
+        yield client
+        self.checkin(key, client)
+
+    def key(self, api_base, consumer_key, consumer_secret, resource_tokens):
+        # The secrets are part of the key so that a request can only get a
+        # client created with the same credentials, but only their hash is
+        # kept in the key.
+        secrets = hashlib.sha1(consumer_secret)
+        token = None
+        if resource_tokens:
+            token = resource_tokens['oauth_token']
+            secrets.update('&' + resource_tokens['oauth_token_secret'])
+        return (api_base, consumer_key, token, secrets.hexdigest())
+
+    def checkout(self, key):
+        with self.lock:
+            clients = self.idle.pop(key, None)
+            if not clients:
+                return None
+            client = clients.pop()
+            self.nidle -= 1
+            if clients:
+                self.idle[key] = clients
+            return client
+
+    def checkin(self, key, client):
+        with self.lock:
+            clients = self.idle.pop(key, [])
+            if len(clients) < self.max_idle_per_key:
+                clients.append(client)
+                self.nidle += 1
+            self.idle[key] = clients
+
+            # Drop the clients of the least recently used credentials
+            while self.nidle > self.max_idle:
+                oldest, clients = self.idle.popitem(last=False)
+                self.nidle -= len(clients)
+
+    def clear(self):
+        with self.lock:
+            self.idle.clear()
+            self.nidle = 0